@@ -13,7 +13,6 @@ import popen2
 import random
 import re
 import select
-import sha
 import shutil
 import socket
 import sys
@@ -24,7 +23,7 @@ import urllib2
 import isconf
 from isconf.Errno import iserrno
 from isconf.Globals import *
-from isconf.fbp822 import fbp822
+from isconf.fbp822 import fbp822, hmackey, digests
 from isconf.Kernel import kernel
 
 (START,IHAVE,SENDME) = range(3)
@@ -55,11 +54,23 @@ class Cache:
         self.udpport = udpport
         self.httpport = httpport
         self.timeout = float(timeout)
+        # how long an HTTP fetch may go without hearing from the
+        # peer -- it holds one of kernel.offload()'s few workers
+        # while it waits, so it can't be forever
+        self.httptimeout = self.timeout * 5
         self.lastSend = 0
         self.sock = None
         self.fetched = {}
         self.nets = self.readnets()
         self.sendq = []
+        # peers which have told us they can read binary frames, and
+        # when they last said so
+        self.binpeers = {}
+        # how long to go on believing them -- a host can be
+        # downgraded, and text frames always work
+        self.binttl = self.timeout * 30
+        # most packets to take at a time off the UDP socket
+        self.rxbatch = 64
 
         # temporary uid -- uniquely identifies host in non-persistent
         # packets.  If we want something permanent we should store it
@@ -103,9 +114,45 @@ class Cache:
             return
         mtime = getmtime_int(fullpath)
         reply = FBP.msg('ihave',tuid=self.tuid,
-                file=path,mtime=mtime,port=self.httpport,scheme='http')
+                file=path,mtime=mtime,port=self.httpport,scheme='http',
+                frames='binary')
         HMAC.msgset(reply)
-        self.bcast(str(reply))
+        self.bcast(reply)
+
+    def sawpeer(self,ip,msg):
+        """note whether the peer at ip can read binary frames, going
+        by a packet it sent us
+
+        >>> cache = Cache(54321,54322)
+        >>> cache.sawpeer('10.1.1.1',FBP.msg('whohas',frames='binary'))
+        >>> cache.binpeer('10.1.1.1'), cache.binpeer('10.1.1.2')
+        (True, False)
+        >>> cache.binpeers['10.1.1.1'] -= cache.binttl + 1
+        >>> cache.binpeer('10.1.1.1'), cache.binpeers
+        (False, {})
+        >>> cache.sawpeer('10.1.1.1',FBP.msg('whohas',frames='binary'))
+        >>> cache.sawpeer('10.1.1.1',FBP.msg('whohas'))
+        >>> cache.binpeer('10.1.1.1')
+        False
+
+        """
+        if msg['frames'] == 'binary':
+            self.binpeers[ip] = time.time()
+        elif self.binpeers.has_key(ip):
+            # every packet we send says frames=binary, so this
+            # one's from an older version
+            del self.binpeers[ip]
+
+    def binpeer(self,ip):
+        """true if the peer at ip has said recently that it can read
+        binary frames"""
+        seen = self.binpeers.get(ip,None)
+        if seen is None:
+            return False
+        if seen < time.time() - self.binttl:
+            del self.binpeers[ip]
+            return False
+        return True
 
     def bcast(self,msg):
         # XXX only udp supported so far
@@ -125,9 +172,15 @@ class Cache:
             yield kernel.sigsleep, 1
             while len(self.sendq):
                 msg,addr,udpport = self.sendq.pop(0)
+                # broadcasts always go as text, since not every
+                # peer may be able to read binary frames
+                if self.binpeer(addr):
+                    data = msg.as_binary(unixfrom=True)
+                else:
+                    data = str(msg)
                 try:
-                    debug("sendto", addr, msg)
-                    self.sock.sendto(msg,0,(addr,udpport))
+                    debug("sendto", addr, data)
+                    self.sock.sendto(data,0,(addr,udpport))
                 except:
                     info("sendto failed: %s" % addr)
                     self.sendq.append((msg,addr,udpport))
@@ -164,7 +217,7 @@ class Cache:
             debug("remote is newer:",url)
             if self.req.has_key(path):
                 self.req[path]['state'] = SENDME
-            yield kernel.wait(self.wget(path,url,challenge))
+            yield kernel.wait(self.wget(path,url,challenge),sched='bulk')
         elif mtime < mymtime:
             debug("remote is older:",url)
             self.ihaveTx(path)
@@ -199,7 +252,8 @@ class Cache:
                 mtime = 0
                 if os.path.exists(fullpath):
                     mtime = getmtime_int(fullpath)
-                req = FBP.msg('whohas',file=path,newer=mtime,tuid=self.tuid)
+                req = FBP.msg('whohas',file=path,newer=mtime,tuid=self.tuid,
+                        frames='binary')
                 HMAC.msgset(req)
                 self.req.setdefault(path,{})
                 self.req[path]['msg'] = req
@@ -237,7 +291,7 @@ class Cache:
                 continue
             req = self.req[path]['msg']
             debug("calling bcast")
-            self.bcast(str(req))
+            self.bcast(req)
 
     def flush(self):
         if not os.path.exists(self.p.announce):
@@ -296,7 +350,9 @@ class Cache:
         if not os.path.exists(dir):
             os.makedirs(dir,0700)
         try:
-            u = urllib2.urlopen(url)
+            # connect and wait for headers in a worker thread
+            u = yield kernel.offload(urllib2.urlopen,url,None,
+                    self.httptimeout)
         except:
             debug("HTTP failed opening %s" % url)
             return
@@ -324,28 +380,17 @@ class Cache:
         os.chmod(tmp,0600)
         open(tmp,'w')  # what does this second open do?
         tmpfd = open(tmp,'a')
-        while True:
-            # XXX move timeout to here
-            yield kernel.sigbusy
-            try:
-                (r,w,e) = select.select([u],[],[u],0)
-                if e:
-                    # XXX not sure if we should break or raise here
-                    break
-                if not r:
-                    continue
-            except:
-                # python 2.4 throws a "no fileno attribute" exception if 
-                # the entire page content has already arrived
-                pass
-            try:
-                rxd = u.read(8192) 
-            except:
-                break
-            if len(rxd) == 0:
-                break
-            # XXX show progress
-            tmpfd.write(rxd)
+        try:
+            # the timeout from urlopen() covers these reads too
+            yield kernel.offload(shutil.copyfileobj,u,tmpfd,65536)
+        except:
+            # don't count on the size check to catch a short file --
+            # older peers don't send content-length
+            debug("HTTP failed reading %s" % url)
+            tmpfd.close()
+            u.close()
+            os.unlink(tmp)
+            return
         tmpfd.close()
         actual_size = os.stat(tmp).st_size
         if size is None:
@@ -381,6 +426,8 @@ class Cache:
         dir = self.p.cache
         udpport = self.udpport
 
+        factory = fbp822()
+
         debug("UDP server serving %s on port %d" % (dir,udpport))
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock = sock
@@ -393,61 +440,77 @@ class Cache:
         while True:
             yield None
             self.flush()
-            yield None
+            yield kernel.sigio, [sock], [], 1
+            # read everything that's waiting, then check the HMACs on
+            # the lot in one go
+            batch = []
+            got = 0
             try:
-                data,addr = sock.recvfrom(8192)
-                # XXX check against addrs or nets
-                debug("from %s: %s" % (addr,data))
-                factory = fbp822()
-                msg = factory.parse(data)
-                type = msg.type().strip()
-                if msg.head.tuid == self.tuid:
-                    # debug("one of ours -- ignore",str(msg))
+                while got < self.rxbatch:
+                    data,addr = sock.recvfrom(8192)
+                    got += 1
+                    # XXX check against addrs or nets
+                    debug("from %s: %s" % (addr,data))
+                    try:
+                        msg = factory.parse(data)
+                    except Exception, e:
+                        warn("%s from %s: %s" % (e,addr,repr(data)))
+                        continue
+                    if msg.head.tuid == self.tuid:
+                        # debug("one of ours -- ignore",str(msg))
+                        continue
+                    batch.append((msg,addr))
+            except socket.error:
+                if not got:
+                    yield kernel.sigsleep, 1
                     continue
-                if not HMAC.msgck(msg):
+            oks = HMAC.msgckall([ msg for (msg,addr) in batch ])
+            for i in range(len(batch)):
+                (msg,addr) = batch[i]
+                if not oks[i]:
                     debug("HMAC failed, dropping: %s" % msg)
                     continue
-                if type == 'whohas':
-                    path = msg['file']
-                    path = path.lstrip('/')
-                    fullpath = os.path.join(dir,path)
-                    fullpath = os.path.normpath(fullpath)
-                    newer = int(msg.get('newer',None))
-                    # security checks
-                    bad=0
-                    if fullpath != os.path.normpath(fullpath): 
-                        bad += 1
-                    if dir != os.path.commonprefix(
-                            (dir,os.path.abspath(fullpath))):
-                        print dir,os.path.commonprefix(
-                            (dir,os.path.abspath(fullpath)))
-                        bad += 2
-                    if bad:
-                        warn("unsafe request %d from %s: %s" % (
-                            bad,addr,fullpath))
-                        continue
-                    if not os.path.isfile(fullpath):
-                        debug("ignoring whohas from %s: not found: %s" % (addr,fullpath))
+                try:
+                    type = msg.type().strip()
+                    self.sawpeer(addr[0],msg)
+                    if type == 'whohas':
+                        path = msg['file']
+                        path = path.lstrip('/')
+                        fullpath = os.path.join(dir,path)
+                        fullpath = os.path.normpath(fullpath)
+                        newer = int(msg.get('newer',None))
+                        # security checks
+                        bad=0
+                        if fullpath != os.path.normpath(fullpath): 
+                            bad += 1
+                        if dir != os.path.commonprefix(
+                                (dir,os.path.abspath(fullpath))):
+                            print dir,os.path.commonprefix(
+                                (dir,os.path.abspath(fullpath)))
+                            bad += 2
+                        if bad:
+                            warn("unsafe request %d from %s: %s" % (
+                                bad,addr,fullpath))
+                            continue
+                        if not os.path.isfile(fullpath):
+                            debug("ignoring whohas from %s: not found: %s" % (addr,fullpath))
+                            continue
+                        if newer is not None and newer >= getmtime_int(
+                                fullpath):
+                            debug("ignoring whohas from %s: not newer: %s" % (addr,fullpath))
+                            continue
+                        # url = "http://%s:%d/%s" % (localip,httpport,path)
+                        self.ihaveTx(path)
                         continue
-                    if newer is not None and newer >= getmtime_int(
-                            fullpath):
-                        debug("ignoring whohas from %s: not newer: %s" % (addr,fullpath))
+                    if type == 'ihave':
+                        debug("gotihave:",str(msg))
+                        ip = addr[0]
+                        yield kernel.wait(self.ihaveRx(msg,ip))
                         continue
-                    # url = "http://%s:%d/%s" % (localip,httpport,path)
-                    self.ihaveTx(path)
-                    continue
-                if type == 'ihave':
-                    debug("gotihave:",str(msg))
-                    ip = addr[0]
-                    yield kernel.wait(self.ihaveRx(msg,ip))
+                    warn("unsupported message type from %s: %s" % (addr,type))
+                except Exception, e:
+                    warn("%s from %s: %s" % (e,addr,str(msg)))
                     continue
-                warn("unsupported message type from %s: %s" % (addr,type))
-            except socket.error:
-                yield kernel.sigsleep, 1
-                continue
-            except Exception, e:
-                warn("%s from %s: %s" % (e,addr,str(msg)))
-                continue
 
 
 def httpServer(port,dir):
@@ -503,7 +566,7 @@ def httpServer(port,dir):
     svr.socket.setblocking(0)
     debug("HTTP server serving %s on port %d" % (dir,port))
     while True:
-        yield None
+        yield kernel.sigio, [svr.socket], []
         try:
             request, client_address = svr.get_request()
         except socket.error:
@@ -595,7 +658,11 @@ class Hmac:
 
     def reset(self):
         self._keys = []
+        # hmackey() of each of _keys
+        self._states = []
         self.any = False
+        # digest for the HMACs we make -- we check any we know
+        self.digest = 'sha1'
 
     def reload(self):
         path = os.environ.get('IS_HMAC_KEYS',None)
@@ -608,6 +675,11 @@ class Hmac:
             debug("reloading",path)
             self.mtime = getmtime_int(path)
             self.reset()
+            digest = os.environ.get('IS_HMAC_DIGEST','sha1')
+            if digests.has_key(digest):
+                self.digest = digest
+            else:
+                warn("IS_HMAC_DIGEST: %s not available, using sha1" % digest)
             for line in open(path,'r').readlines():
                 line = line.strip()
                 if line.startswith('#'):
@@ -618,26 +690,42 @@ class Hmac:
                     self.any = True
                     continue
                 self._keys.append(line)
+                self._states.append(hmackey(line))
         # debug('XXX keys',self._keys)
         return self._keys
 
     def msgck(self,msg):
+        return self.msgckall([msg])[0]
+
+    def msgckall(self,msgs):
+        """msgck() a batch of messages, returning a list of results.
+        The key file is only checked once for the lot.
+
+        >>> HMAC = Hmac()
+        >>> keyfile = "/tmp/hmac_keys-test-case-data"
+        >>> open(keyfile,'w').write("newkey\\noldkey\\n")
+        >>> os.environ['IS_HMAC_KEYS'] = keyfile
+        >>> factory = fbp822()
+        >>> msgs = [ factory.mkmsg('apple') for i in range(3) ]
+        >>> HMAC.msgset(msgs[0])
+        '1e058bf8853f1a0d8324cbeff8367664ef6eb19a'
+        >>> msgs[1].hmacset('oldkey')
+        '27f5a014b81e580bfaa01fb387ecd8f1fcc94047'
+        >>> HMAC.msgckall(msgs)
+        [True, True, False]
+
+        """
         keys = self.reload()
-        if not len(keys):
-            return True
-        if self.any:
-            return True
-        for key in keys:
-            if msg.hmacok(key):
-                return True
-        return False
+        if not len(keys) or self.any:
+            return [True] * len(msgs)
+        states = self._states
+        return [ msg.hmacmatch(states) is not None for msg in msgs ]
 
     def msgset(self,msg):
         keys = self.reload()
         if not len(keys):
             return
-        key = keys[0]
-        return msg.hmacset(key)
+        return msg.hmacset(self._states[0],self.digest)
 
     def ck(self,challenge,response):
         debug('ck(): challenge',challenge)
@@ -647,23 +735,49 @@ class Hmac:
             return True
         if self.any:
             return True
-        for key in keys:
-            h = hmac.new(key,msg=challenge,digestmod=sha)
-            digest = h.hexdigest()
-            if digest == response:
+        if not response:
+            debug('ck: no response')
+            return False
+        # digest=hex, or just hex for sha1
+        digest = 'sha1'
+        if '=' in response:
+            (digest,response) = response.split('=',1)
+        if not digests.has_key(digest):
+            debug('ck: unsupported digest',digest)
+            return False
+        for key in self._states:
+            h = key.new(digest)
+            h.update(challenge)
+            if hmac.compare_digest(h.hexdigest(),response):
                 debug('ck: response ok')
-                debug('XXX ck(): key',key)
                 return True
         debug('ck: bad response')
         return False
 
     def response(self,challenge):
+        """Answer challenge with an HMAC of it, made with the first
+        key.  Unless it's sha1, the digest's name goes on the front.
+
+        >>> HMAC = Hmac()
+        >>> os.environ['IS_HMAC_KEYS'] = "/tmp/hmac_keys-test-case-data"
+        >>> os.environ['IS_HMAC_DIGEST'] = 'sha256'
+        >>> open(os.environ['IS_HMAC_KEYS'],'w').write("somekey\\n")
+        >>> res = HMAC.response('foo')
+        >>> res
+        'sha256=7433ed0341ec9cdd5b8cab5445df4d9c1d7c91c9d8db562b9b9d02d9dba127ba'
+        >>> HMAC.ck('foo',res), HMAC.ck('foo',res[7:]), HMAC.ck('bar',res)
+        (True, False, False)
+        >>> del os.environ['IS_HMAC_DIGEST']
+
+        """
         keys = self.reload()
         if not len(keys):
             return
-        key = keys[0]
-        h = hmac.new(key,msg=challenge,digestmod=sha)
+        h = self._states[0].new(self.digest)
+        h.update(challenge)
         response = h.hexdigest()
+        if self.digest != 'sha1':
+            response = '%s=%s' % (self.digest,response)
         debug('response(): challenge',challenge)
         debug('response(): response',response)
         return response
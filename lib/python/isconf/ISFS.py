@@ -4,13 +4,16 @@
 # vim:set tabstop=4:
 
 from __future__ import generators
+import collections
 import ConfigParser
 import copy
 import email.Message
 import email.Parser
 import errno
+import gc
 import inspect
 import md5
+import mmap
 import os
 import popen2
 import random
@@ -25,11 +28,60 @@ import time
 import urllib2
 
 import isconf
+from isconf.Cache import HMAC
 from isconf.Errno import iserrno
 from isconf.Globals import *
-from isconf.fbp822 import fbp822
+from isconf.fbp822 import fbp822, Error822, Parser822
 from isconf.Kernel import kernel
 
+def filesums(path):
+    """md5 and sha1 of a file; blocking, so run it via kernel.offload()
+
+    >>> open("/tmp/filesums.test",'w').write("abc")
+    >>> filesums("/tmp/filesums.test")['sha']
+    'a9993e364706816aba3e25717850c26c9cd0d89d'
+
+    """
+    m = md5.new()
+    s = sha.new()
+    fh = open(path,'rb')
+    while True:
+        data = fh.read(1024 * 1024)
+        if not data:
+            break
+        m.update(data)
+        s.update(data)
+    fh.close()
+    return {'md5': m.hexdigest(), 'sha': s.hexdigest()}
+
+def foldjournal(cp,path,records):
+    """fold the journal entries for index records into Checkpoint cp,
+    and return it; blocking, so run it via kernel.offload()
+
+    >>> fn = tempfile.mktemp()
+    >>> j = Journal(fn)
+    >>> for (xid,name) in (('x1','/a'),('x2','/b'),('x3','/a')):
+    ...     j.addraw(str(FBP.msg('snap',pathname=name,blk=xid,xid=xid)))
+    >>> cp = foldjournal(Checkpoint(),fn,j.index()[:2])
+    >>> (cp.entries, cp.xid, sorted(cp.xids()))
+    (2, 'x2', ['x1', 'x2'])
+    >>> cp = foldjournal(cp,fn,j.index()[2:])
+    >>> (cp.entries, cp.xid, sorted(cp.xids()))
+    (3, 'x3', ['x2', 'x3'])
+
+    """
+    n = len(records)
+    entries = []
+    journal = open(path,'rb')
+    journal.seek(records[0].offset)
+    for mlist in FBP.fromFile(journal,intask=False,batch=True):
+        entries.extend(mlist)
+        if len(entries) >= n:
+            break
+    journal.close()
+    cp.add(entries[:n],records[-1])
+    return cp
+
 class XXXFile:
     # XXX This version stores one block per write -- this is the way
     # we want to go.  The thing missing here is that we need to nest
@@ -106,6 +158,7 @@ class File:
         #
         # build journal transaction message
         os.close(self.tmp)
+        size = os.path.getsize(self.tmpfn)
         fbp = fbp822()
         parent = os.path.dirname(self.path)
         pathmodes = []
@@ -126,6 +179,7 @@ class File:
                 st_gid = self.st.st_gid,
                 st_atime = self.st.st_atime,
                 st_mtime = self.st.st_mtime,
+                st_size = size,
                 pathmodes = ','.join(pathmodes)
                 )
         debug("calling addwip")
@@ -133,18 +187,81 @@ class File:
         self.volume.closefile(self)
         info("snapshot done:", self.path)
 
+# one line of a journal's index -- see Journal.index()
+IndexRecord = collections.namedtuple('IndexRecord',
+    'xid offset length type blk hash')
+
+def readindex(txt):
+    """Parse the text of a journal index file, return (records, end
+    of the last entry, checksum of the journal up to there, length
+    of the records part), or None if it's damaged.
+
+    >>> txt = "a\\t0\\t10\\tsnap\\tb\\tc1\\nx\\\\ty\\t10\\t5\\texec\\t\\tc2\\n"
+    >>> (index,end,digest,size) = readindex(txt + "end\\t15\\tabc\\n")
+    >>> [ (r.xid, r.offset, r.type, r.blk) for r in index ]
+    [('a', 0, 'snap', 'b'), ('x\\ty', 10, 'exec', '')]
+    >>> (end, digest, size == len(txt))
+    (15, 'abc', True)
+    >>> readindex(txt + "end\\t14\\tabc\\n")
+    >>> readindex(txt[:-3] + "end\\t15\\tabc\\n")
+
+    """
+    # a column at a time, rather than a line at a time -- there can
+    # be hundreds of thousands of them
+    lines = txt.split('\n')
+    try:
+        if lines.pop() != '':
+            return None
+        trailer = lines.pop()
+        (tag,end,digest) = trailer.split('\t')
+        end = int(end)
+        if tag != 'end':
+            return None
+        rows = [ line.split('\t') for line in lines ]
+        if rows and set(map(len,rows)) != set([6]):
+            return None
+        (xids,offsets,lengths,types,blks,hashes) = zip(*rows) or [()] * 6
+        offsets = map(int,offsets)
+        lengths = map(int,lengths)
+    except (ValueError,IndexError):
+        return None
+    if rows and offsets[-1] + lengths[-1] != end:
+        return None
+    if '\\' in txt:
+        unescape = lambda col: [ v.decode('string_escape') for v in col ]
+        (xids,types,blks) = map(unescape,(xids,types,blks))
+    index = map(IndexRecord,xids,offsets,lengths,types,blks,hashes)
+    return (index, end, digest, len(txt) - len(trailer) - 1)
+
 class Journal:
 
     def __init__(self,fullpath):
         self.path = fullpath
+        self.idxpath = "%s.idx" % fullpath
+        self._reset()
+
+    def _reset(self):
+        # index records, and the messages for the first
+        # len(self._entries) of them
+        self._index = []
         self._entries = []
-        self._mtime = 0
+        # (dev, ino, size, mtime) when we last looked, how far into
+        # the file the last whole entry ends, a running checksum of
+        # everything up to there, and the last few bytes of it
+        self._stat = None
+        self._end = 0
+        self._sum = sha.new()
+        self._tail = ''
+        # how many records the index file holds, and how many bytes
+        # of it they take up
+        self._saved = (0,0)
 
     def addraw(self,data):
         fh = open(self.path,'a')
         fh.write(data)
         fh.close()
-        self._mtime = 0
+        # bring the index file up to date
+        self.index()
 
     def copy(self,other):
         """Given another journal object, ensure self is empty, then 
@@ -167,25 +284,263 @@ class Journal:
         >>> assert not b.copy(a)
 
         """
-        if self.entries():
+        if self.index():
             return False
         ofn = other.path
         shutil.copy(ofn,self.path)
-        self._mtime = 0
+        if os.path.exists(other.idxpath):
+            # checked against the journal before it's used
+            shutil.copy(other.idxpath,self.idxpath)
+        self._reset()
         return True
 
     def entries(self):
-        if not hasattr(self,"_entries"):
-            self._entries = []
-        if os.path.exists(self.path):
-            mtime = getmtime_int(self.path)
-            if mtime != self._mtime:
-                self._entries = self._parse()
-                self._mtime = mtime
-        else:
-            self._entries = []
+        """Return the journal's messages.
+
+        >>> fn = tempfile.mktemp()
+        >>> j = Journal(fn)
+        >>> j.addraw(str(FBP.msg('test',xid='abcd')))
+        >>> [ x.head.xid for x in j.entries() ]
+        ['abcd']
+        >>> j.addraw(str(FBP.msg('test',xid='defg')))
+        >>> [ x.head.xid for x in j.entries() ]
+        ['abcd', 'defg']
+        >>> raw = open(fn).read().replace('abcd','wxyz')
+        >>> tmp = fn + '.tmp'
+        >>> open(tmp,'w').write(raw + str(FBP.msg('test',xid='efgh')))
+        >>> os.rename(tmp,fn)
+        >>> [ x.head.xid for x in j.entries() ]
+        ['wxyz', 'defg', 'efgh']
+        >>> open(fn,'w').write(str(FBP.msg('test',xid='hijk')))
+        >>> [ x.head.xid for x in j.entries() ]
+        ['hijk']
+
+        """
+        self._sync()
+        have = len(self._entries)
+        if have < len(self._index):
+            # a new list, in case a caller is still using the old one
+            self._entries = self._entries + self._parseat(have)
         return self._entries
 
+    def entriesfrom(self,i):
+        """Return the journal's messages from the i'th on, without
+        parsing the ones before it if we haven't already.
+
+        >>> fn = tempfile.mktemp()
+        >>> j = Journal(fn)
+        >>> for xid in ('abcd','defg','efgh'):
+        ...     j.addraw(str(FBP.msg('test',xid=xid)) + "\\n\\n")
+        >>> j = Journal(fn)
+        >>> [ x.head.xid for x in j.entriesfrom(1) ]
+        ['defg', 'efgh']
+        >>> len(j._entries)
+        0
+
+        """
+        if i <= len(self._entries):
+            return self.entries()[i:]
+        self._sync()
+        if i >= len(self._index):
+            return []
+        return self._parseat(i)
+
+    def index(self):
+        """Return the journal's index:  for each entry, an IndexRecord
+        of its xid, where it is in the file and how long, its type,
+        its blk if it's a snap, and a rolling hash -- a sha1 of the
+        previous entry's hash and this entry's text -- which stands
+        for the whole journal up to and including it.
+
+        The index is kept in a file next to the journal, so it needn't
+        be rebuilt by parsing the whole journal every time we start.
+        If that file is missing, or doesn't match the journal, it's
+        rebuilt.
+
+        Journals only ever grow, so once we've read the journal we
+        only parse what's been appended since.  We start over if the
+        file has shrunk, or if what we read before has changed:  when
+        it's the same file, grown, we check the last few bytes we had
+        are still there; when the file's been replaced -- pulled from
+        another host, say -- we check the checksum of the whole lot.
+
+        >>> fn = tempfile.mktemp()
+        >>> j = Journal(fn)
+        >>> j.addraw(str(FBP.msg('test',xid='abcd')) + "\\n\\n")
+        >>> j.addraw(str(FBP.msg('snap',xid='defg',blk='xyz')))
+        >>> [ (r.xid, r.type, r.blk) for r in j.index() ]
+        [('abcd', 'test', ''), ('defg', 'snap', 'xyz')]
+        >>> r = j.index()[1]
+        >>> open(fn).read()[r.offset:r.offset+r.length][:5]
+        'From '
+        >>> Journal(fn).index() == j.index()
+        True
+        >>> open(j.idxpath,'a').write("junk")
+        >>> Journal(fn).index() == j.index()
+        True
+
+        """
+        self._sync()
+        return self._index
+
+    def _sync(self):
+        """bring the index up to date with the journal file"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._reset()
+            return
+        stat = (st.st_dev,st.st_ino,st.st_size,st.st_mtime)
+        if stat == self._stat:
+            return
+        journal = open(self.path,'rb')
+        if self._stat is None:
+            self._load(journal,st)
+        if not self._prefixok(journal,st):
+            self._reset()
+        (entries,spans) = self._parse(journal,self._end)
+        if entries:
+            if len(self._entries) == len(self._index):
+                self._entries = self._entries + entries
+            self._index = self._index + self._records(journal,entries,spans)
+            end = spans[-1][1]
+            self._tail = self._addsum(journal,self._end,end)
+            self._end = end
+            self._save()
+        journal.close()
+        self._stat = stat
+
+    def _records(self,journal,entries,spans):
+        """index records for entries, found at spans in journal"""
+        records = []
+        hash = ''
+        if self._index:
+            hash = self._index[-1].hash
+        m = mmap.mmap(journal.fileno(),0,access=mmap.ACCESS_READ)
+        for i in xrange(len(entries)):
+            msg = entries[i]
+            (start,end) = spans[i]
+            hash = sha.new(hash + m[start:end]).hexdigest()
+            type = msg.type()
+            blk = ''
+            if type == 'snap':
+                blk = msg.get('blk','')
+            records.append(IndexRecord(msg.get('xid',''),start,end - start,
+                type,blk,hash))
+        m.close()
+        return records
+
+    def _load(self,journal,st):
+        """pick up where the index file left off, if it still matches
+        the journal"""
+        try:
+            txt = open(self.idxpath,'rb').read()
+        except EnvironmentError:
+            return
+        # the collector would otherwise walk everything we have once
+        # for every few hundred records we make
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            got = readindex(txt)
+        finally:
+            if enabled:
+                gc.enable()
+        if got is None:
+            return
+        (index,end,digest,size) = got
+        if end > st.st_size:
+            return
+        tail = self._addsum(journal,0,end)
+        if self._sum.hexdigest() != digest:
+            self._reset()
+            return
+        self._index = index
+        self._end = end
+        self._tail = tail
+        self._saved = (len(index),size)
+        # checked up to end, but not looked at past it yet
+        self._stat = (st.st_dev,st.st_ino,None,None)
+
+    def _save(self):
+        """write out the index file.  If it already holds the records
+        we last saved, the new ones and a fresh trailer are written
+        over its old trailer; otherwise the whole thing is written to
+        a temp file which is then renamed into place.  Either way, a
+        write that's cut short leaves a file readindex() rejects, and
+        the index is rebuilt."""
+        (n,size) = self._saved
+        fh = None
+        if n:
+            try:
+                fh = open(self.idxpath,'r+b')
+                fh.seek(size - 1)
+                if fh.read(1) != '\n':
+                    fh = None
+            except EnvironmentError:
+                fh = None
+        if fh is None:
+            (n,size) = (0,0)
+        new = ''.join([ "%s\t%d\t%d\t%s\t%s\t%s\n" % (
+            r.xid.encode('string_escape'),r.offset,r.length,
+            r.type.encode('string_escape'),r.blk.encode('string_escape'),
+            r.hash) for r in self._index[n:] ])
+        trailer = "end\t%d\t%s\n" % (self._end,self._sum.hexdigest())
+        try:
+            if fh:
+                fh.seek(size)
+                fh.write(new + trailer)
+                fh.truncate()
+                fh.close()
+            else:
+                tmp = "%s.tmp" % self.idxpath
+                fh = open(tmp,'wb')
+                fh.write(new)
+                fh.write(trailer)
+                fh.close()
+                os.rename(tmp,self.idxpath)
+        except EnvironmentError, e:
+            debug("journal index not saved:", e)
+            self._saved = (0,0)
+            return
+        self._saved = (len(self._index), size + len(new))
+
+    def _prefixok(self,journal,st):
+        """true if the first self._end bytes of the journal are what
+        we parsed last time"""
+        if st.st_size < self._end:
+            return False
+        if not self._end:
+            return True
+        if self._stat and self._stat[:2] == (st.st_dev,st.st_ino):
+            journal.seek(self._end - len(self._tail))
+            return journal.read(len(self._tail)) == self._tail
+        s = sha.new()
+        journal.seek(0)
+        left = self._end
+        while left:
+            data = journal.read(min(left,1024 * 1024))
+            if not data:
+                return False
+            s.update(data)
+            left -= len(data)
+        return s.digest() == self._sum.digest()
+
+    def _addsum(self,journal,start,end):
+        """add bytes start through end of the journal to the running
+        checksum, return the last 4k of everything up to end"""
+        journal.seek(start)
+        left = end - start
+        tail = self._tail
+        while left:
+            data = journal.read(min(left,1024 * 1024))
+            if not data:
+                break
+            self._sum.update(data)
+            left -= len(data)
+            tail = (tail + data[-4096:])[-4096:]
+        return tail
+
     def migrate(self,other,append=False):
         """Given another journal object, ensure other is a superset of
         self, then if append=True, append remaining entries from other 
@@ -221,65 +576,336 @@ class Journal:
         >>> [ x.head.xid for x in b.entries() ]
         ['abcd', 'defg', 'efgh', 'jklm']
 
+        Entries copied over as reformatted text still count:
+
+        >>> cfn = tempfile.mktemp()
+        >>> c = Journal(cfn)
+        >>> raw = ''.join([ str(x) for x in a.entries()[:2] ])
+        >>> c.addraw(raw.replace('From fbp822 ','From isconf '))
+        >>> c.index()[-1].hash == a.index()[1].hash
+        False
+        >>> assert c.migrate(a,append=True)
+        >>> [ x.head.xid for x in c.entries() ]
+        ['abcd', 'defg', 'efgh', 'hijk']
+
         """
-        sentries = self.entries()
-        oentries = other.entries()
-        # make sure other is a superset
-        if len(sentries) > len(oentries):
+        sindex = self.index()
+        oindex = other.index()
+        # make sure other is a superset -- the rolling hash of our
+        # last entry stands for all of them.  A branch migrated by
+        # older code holds the same messages reformatted, so if the
+        # bytes differ, fall back to comparing xids.
+        i = len(sindex)
+        if i > len(oindex):
             return False
-        i=0
-        while i < len(sentries):
-            if str(sentries[i]) != str(oentries[i]):
+        if i and sindex[-1].hash != oindex[i-1].hash:
+            sxids = [ r.xid for r in sindex ]
+            oxids = [ r.xid for r in oindex[:i] ]
+            if sxids != oxids:
                 return False
-            i += 1
         if not append:
             return True
         # append new entries from other
-        while i < len(oentries):
-            self.addraw(str(oentries[i]))
-            i += 1
+        if i < len(oindex):
+            self.addraw(other.raw(i))
         return True
 
+    def raw(self,i=0):
+        """return the text of the journal's entries from the i'th on"""
+        index = self.index()
+        journal = open(self.path,'rb')
+        chunks = []
+        for r in index[i:]:
+            journal.seek(r.offset)
+            chunks.append(journal.read(r.length))
+        journal.close()
+        return ''.join(chunks)
+
     def mtime(self):
-        # do NOT update self._mtime here -- entries() needs to do that
         mtime = 0
         if os.path.exists(self.path):
             mtime = getmtime_int(self.path)
         return mtime
 
-    def _parse(self):
+    def _parse(self,journal,start):
+        """parse the journal from byte offset start, return the
+        entries and the (start, end) offsets of each"""
         entries = []
-        journal = open(self.path,'r')
-        messages = FBP.fromFile(journal)
-        for msg in messages:
-            if msg in (kernel.eagain,None):
-                continue
-            entries.append(msg)
-        return entries
+        journal.seek(start)
+        parser = Parser822(spans=[])
+        for mlist in FBP.fromFile(journal,intask=False,batch=True,
+                parser=parser):
+            entries.extend(mlist)
+        return (entries, parser.spans)
+
+    def _parseat(self,i):
+        """parse the entries for index records i onward"""
+        journal = open(self.path,'rb')
+        (entries,spans) = self._parse(journal,self._index[i].offset)
+        journal.close()
+        return entries[:len(self._index) - i]
 
 class History:
+    """The xids this host has applied, in the order it applied them.
+
+    The file is append-only, so we keep what we've read of it and
+    only read lines added since; a file that's been replaced or
+    has shrunk gets read again from the top.
+
+    >>> fn = tempfile.mktemp()
+    >>> h = History(fn)
+    >>> open(fn,'w').close()
+    >>> h.xidlist()
+    []
+    >>> h.add({'xid': 'abcd'})
+    >>> h.add({'xid': 'defg'})
+    >>> h.xidlist()
+    ['abcd', 'defg']
+    >>> 'defg' in h.xidset(), 'efgh' in h.xidset()
+    (True, False)
+    >>> open(fn,'a').write("1234567890 efgh\\n1234567890 hi")
+    >>> h.xidlist()
+    ['abcd', 'defg', 'efgh']
+    >>> open(fn,'a').write("jk\\n")
+    >>> h.xidlist()
+    ['abcd', 'defg', 'efgh', 'hijk']
+    >>> h.addxids(['lmno', 'pqrs'])
+    >>> h.xidlist()[3:]
+    ['hijk', 'lmno', 'pqrs']
+    >>> tmp = fn + '.tmp'
+    >>> open(tmp,'w').write("1234567890 wxyz\\n")
+    >>> os.rename(tmp,fn)
+    >>> h.xidlist()
+    ['wxyz']
+    >>> sorted(h.xidset())
+    ['wxyz']
+
+    """
 
     def __init__(self,fullpath):
         self.path = fullpath
+        self._reset()
+
+    def _reset(self):
         self._xids = []
-        self._mtime = 0
+        self._done = set()
+        # (dev, ino) of the file we've been reading, and how many
+        # bytes of it we've read
+        self._stat = None
+        self._size = 0
 
     def add(self,msg):
         line = "%d %s\n" % (time.time(), msg['xid'])
         open(self.path,'a').write(line)
 
+    def addxids(self,xids):
+        now = int(time.time())
+        lines = [ "%d %s\n" % (now, xid) for xid in xids ]
+        open(self.path,'a').write(''.join(lines))
+
     def xidlist(self):
-        mtime = getmtime_int(self.path)
-        if mtime != self._mtime:
-            self.reload()
-            self._mtime = mtime
+        """the applied xids, oldest first"""
+        self._sync()
         return self._xids
 
-    def reload(self):
-        self._xids = []
-        for line in open(self.path,'r').readlines():
-            (time,xid) = line.strip().split()
-            self._xids.append(xid)
+    def xidset(self):
+        """the applied xids, for membership tests"""
+        self._sync()
+        return self._done
+
+    def _sync(self):
+        st = os.stat(self.path)
+        if self._stat != (st.st_dev,st.st_ino) or st.st_size < self._size:
+            self._reset()
+            self._stat = (st.st_dev,st.st_ino)
+        if st.st_size == self._size:
+            return
+        fh = open(self.path,'r')
+        fh.seek(self._size)
+        txt = fh.read()
+        fh.close()
+        # leave a partly written line for next time
+        txt = txt[:txt.rfind('\n') + 1]
+        words = txt.split()
+        if len(words) == 2 * txt.count('\n'):
+            xids = words[1::2]
+        else:
+            xids = []
+            for line in txt.splitlines():
+                (stamp,xid) = line.strip().split()
+                xids.append(xid)
+        self._xids.extend(xids)
+        self._done.update(xids)
+        self._size += len(txt)
+
+class Checkpoint:
+    """What the snaps in the first n entries of a journal leave on
+    disk:  for each pathname, the headers of the last snap of it.  A
+    host with no history can apply these instead of every snap in
+    those entries, then carry on from entry n.
+
+    As a message, the manifest is the payload, one tab-separated line
+    per path, and 'sum' is its sha1.  'hash' is the rolling hash of
+    entry n, so a checkpoint only matches a journal which starts with
+    the same n entries.  Exec and reboot entries can't be folded into
+    it; 'execs' says how many of them a host starting here skips.
+
+    >>> msgs = [
+    ...     FBP.mkmsg('snap',pathname='/etc/a',blk='1',xid='x1',
+    ...         st_mode=33188,st_uid=0,st_gid=0,st_atime=1,st_mtime=1,
+    ...         pathmodes='16877:0:0,16877:0:0'),
+    ...     FBP.mkmsg('snap',pathname='/etc/b\\tc',blk='2',xid='x2',
+    ...         st_mode=33188,st_uid=0,st_gid=0,st_atime=1,st_mtime=1,
+    ...         pathmodes='16877:0:0,16877:0:0'),
+    ...     FBP.mkmsg('exec','true\\n',cwd='/',xid='x3'),
+    ...     FBP.mkmsg('snap',pathname='/etc/a',blk='3',xid='x4',
+    ...         st_mode=33152,st_uid=0,st_gid=0,st_atime=2,st_mtime=2,
+    ...         pathmodes='16877:0:0,16877:0:0'),
+    ...     ]
+    >>> cp = Checkpoint()
+    >>> cp.add(msgs[:2],IndexRecord('x2',0,0,'snap','2','h2'))
+    >>> cp.add(msgs[2:],IndexRecord('x4',0,0,'snap','3','h4'))
+    >>> (cp.entries, cp.xid, cp.hash, cp.execs)
+    (4, 'x4', 'h4', 1)
+    >>> sorted(cp.xids())
+    ['x2', 'x4']
+    >>> [ (m['pathname'], m['blk'], m['xid']) for m in cp.snaps() ]
+    [('/etc/b\\tc', '2', 'x2'), ('/etc/a', '3', 'x4')]
+    >>> cp.snaps()[1].head.st_mode
+    33152
+    >>> msg = cp.msg()
+    >>> msg.head.entries, msg['sum'] == sha.new(msg.payload()).hexdigest()
+    (4, True)
+    >>> again = Checkpoint.frommsg(FBP.parse(str(msg)))
+    >>> [ m.items() for m in again.snaps() ] == [ m.items() for m in cp.snaps() ]
+    True
+    >>> (again.entries, again.xid, again.hash, again.execs)
+    (4, 'x4', 'h4', 1)
+    >>> msg.set_payload(msg.payload().replace('33152','33279'))
+    >>> Checkpoint.frommsg(msg)
+
+    """
+
+    fields = ('pathname','blk','st_mode','st_uid','st_gid',
+            'st_atime','st_mtime','pathmodes','xid')
+    # File sets these as ints, and updateSnap() wants them back that way
+    ints = ('st_mode','st_uid','st_gid')
+
+    def __init__(self):
+        # pathname -> header values, in the order of their last snap
+        self.paths = collections.OrderedDict()
+        # how many journal entries this covers, the xid and rolling
+        # hash of the last of them, and how many of them were
+        # exec or reboot
+        self.entries = 0
+        self.xid = ''
+        self.hash = ''
+        self.execs = 0
+
+    def add(self,msgs,last):
+        """fold in the next journal entries, msgs; last is the index
+        record of the last of them"""
+        for msg in msgs:
+            type = msg.type()
+            if type == 'snap':
+                pathname = msg['pathname']
+                self.paths.pop(pathname,None)
+                self.paths[pathname] = tuple(
+                        [ msg.get(var,'') for var in self.fields ])
+            elif type in ('exec','reboot'):
+                self.execs += 1
+        self.entries += len(msgs)
+        self.xid = last.xid
+        self.hash = last.hash
+
+    def xids(self):
+        """the xids of the snaps in the manifest"""
+        return set([ row[-1] for row in self.paths.values() ])
+
+    def snaps(self):
+        """snap messages that recreate the manifest"""
+        msgs = []
+        for row in self.paths.values():
+            head = dict(zip(self.fields,row))
+            for var in self.ints:
+                head[var] = int(head[var])
+            msgs.append(FBP.mkmsg('snap','',**head))
+        return msgs
+
+    def msg(self):
+        lines = []
+        for row in self.paths.values():
+            row = [ val.encode('string_escape') for val in row ]
+            lines.append('\t'.join(row) + '\n')
+        txt = ''.join(lines)
+        return FBP.mkmsg('checkpoint',txt,entries=self.entries,
+                xid=self.xid,hash=self.hash,execs=self.execs,
+                sum=sha.new(txt).hexdigest(),time=int(time.time()))
+
+    def frommsg(cls,msg):
+        """the checkpoint in msg, or None if it's been damaged"""
+        txt = msg.payload()
+        if msg.type() != 'checkpoint' \
+                or sha.new(txt).hexdigest() != msg['sum']:
+            return None
+        self = cls()
+        try:
+            self.entries = msg.head.entries
+            self.execs = msg.head.execs
+            for line in txt.splitlines():
+                row = [ val.decode('string_escape')
+                        for val in line.split('\t') ]
+                if len(row) != len(self.fields):
+                    return None
+                self.paths[row[0]] = tuple(row)
+        except ValueError:
+            return None
+        self.xid = msg['xid']
+        self.hash = msg['hash']
+        return self
+    frommsg = classmethod(frommsg)
+
+def elide(msgs,isdir=os.path.isdir):
+    """Plan an update:  return (msg, later) for each of the pending
+    journal messages, where later is None if the message needs to be
+    applied, or a later snap of the same file which makes applying
+    this one pointless.
+
+    That's only so if no exec or reboot comes between the two --
+    they might look at the file -- and if the file's directory is
+    already there, so it doesn't matter which snap's pathmodes make
+    it.  Anything other than a snap is treated like an exec.
+
+    >>> def snap(path,xid):
+    ...     return FBP.mkmsg('snap',pathname=path,xid=xid)
+    >>> msgs = [ snap('/a/f','1'), snap('/a/g','2'), snap('/a/f','3'),
+    ...     FBP.mkmsg('exec','true\\n',xid='4'), snap('/a/f','5'),
+    ...     snap('/b/h','6'), snap('/a/f','7'), snap('/b/h','8') ]
+    >>> def show(plan):
+    ...     print ' '.join([ m['xid'] + (l and '>' + l['xid'] or '')
+    ...         for (m,l) in plan ])
+    >>> show(elide(msgs,isdir=lambda dir: True))
+    1>3 2 3 4 5>7 6>8 7 8
+    >>> show(elide(msgs,isdir=lambda dir: dir == '/a'))
+    1>3 2 3 4 5>7 6 7 8
+
+    """
+    plan = []
+    # pathname -> the next snap of it, back to the last exec
+    later = {}
+    for msg in reversed(msgs):
+        if msg.type() != 'snap':
+            later = {}
+            plan.append((msg,None))
+            continue
+        path = msg['pathname']
+        if later.has_key(path) and isdir(os.path.dirname(path)):
+            plan.append((msg,later[path]))
+            continue
+        later[path] = msg
+        plan.append((msg,None))
+    plan.reverse()
+    return plan
 
 class Volume:
 
@@ -308,6 +934,7 @@ class Volume:
 
         self.p.journal = "%s/journal"     % (cachevol)
         self.p.lock    = "%s/lock"        % (cachevol)
+        self.p.checkpoint = "%s/checkpoint" % (cachevol)
         self.p.block   = "%s/%s/block"    % (self.p.cache,domain)
 
         self.p.wip     = "%s/journal.wip" % (privatevol)
@@ -361,17 +988,20 @@ class Volume:
         path = self.mkrelative(path)
         open(self.p.announce,'a').write(path + "\n")
 
-    def pull(self,bg=False):
+    def pull(self,bg=False,blocks=True):
         files = (
                 self.mkrelative(self.p.journal),
-                self.mkrelative(self.p.lock)
+                self.mkrelative(self.p.lock),
+                self.mkrelative(self.p.checkpoint)
                 )
-        yield kernel.wait(self.pullfiles(files))
+        yield kernel.wait(self.pullfiles(files),sched='bulk')
+        if not blocks:
+            return
         files = self.pendingfiles()
         if bg:
-            kernel.spawn(self.pullfiles(files))
+            kernel.spawn(self.pullfiles(files),sched='bulk')
         else:
-            yield kernel.wait(self.pullfiles(files))
+            yield kernel.wait(self.pullfiles(files),sched='bulk')
 
     def pullfiles(self,files):
         if files:
@@ -388,6 +1018,7 @@ class Volume:
                 continue
             if os.path.getsize(self.p.pull) == 0:
                 break
+            yield kernel.sigsleep, .1
 
     def addwip(self,msg,tmpfn=None):
         debug("in addwip")
@@ -399,9 +1030,10 @@ class Volume:
         msg.setheader('message', message)
         msg.setheader('time',int(time.time()))
         if msg.type() == 'snap':
-            sumtask = kernel.spawn(self.sums(tmpfn),itermode=True)
-            sums = None
-            for sums in sumtask: yield kernel.sigbusy
+            try:
+                sums = yield kernel.offload(filesums,tmpfn)
+            except EnvironmentError:
+                sums = None
             if not sums: 
                 error("unable to checksum",tmpfn)
                 yield False
@@ -412,14 +1044,15 @@ class Volume:
             # XXX check for collisions
 
             # move to block tree
-            shutil.move(tmpfn,path)
+            yield kernel.offload(shutil.move,tmpfn,path)
             # XXX this is too early and will consume disk space on
             # production machines -- don't announce until ci
             self.announce(path)
 
             # apply the update now rather than wait for up command
             debug("spawning updateSnap")
-            task = kernel.spawn(self.updateSnap(msg),itermode=True)
+            task = kernel.spawn(self.updateSnap(msg),itermode=True,
+                    sched='bulk')
 
         if msg.type() == 'exec':
             # run the command
@@ -446,10 +1079,12 @@ class Volume:
             yield res
             return
         # append message to journal wip
-        open(self.p.wip,'a').write(str(msg))
+        fh = open(self.p.wip,'a')
+        msg.writeto(fh,unixfrom=True)
 
         # add a couple of newlines to ensure message separation
-        open(self.p.wip,'a').write("\n\n")
+        fh.write("\n\n")
+        fh.close()
 
 
     def Exec(self,argdata,cwd):
@@ -491,9 +1126,73 @@ class Volume:
         # XXX announce all new block files here (rather than in addwip)
         os.unlink(self.p.wip)
         self.announce(self.p.journal)
+        every = int(os.environ.get('IS_CHECKPOINT_EVERY',1000))
+        if every:
+            yield kernel.wait(self.checkpoint(every))
         info("changes checked in")
         self.unlock()
 
+    def checkpoint(self,every=1):
+        """Bring the volume's checkpoint up to the end of the journal,
+        if that's at least every entries past it.  Sign it, and
+        announce it.  The first one parses the whole journal, so
+        that's done in a worker thread."""
+        index = self.journal.index()
+        cp = self.loadcheckpoint() or Checkpoint()
+        if not index or len(index) - cp.entries < every:
+            return
+        try:
+            cp = yield kernel.offload(foldjournal,cp,self.journal.path,
+                    index[cp.entries:])
+        except EnvironmentError, e:
+            warn("checkpoint not made:", e)
+            return
+        msg = cp.msg()
+        HMAC.msgset(msg)
+        tmp = "%s.tmp" % self.p.checkpoint
+        fh = open(tmp,'w')
+        msg.writeto(fh,unixfrom=True)
+        fh.close()
+        os.rename(tmp,self.p.checkpoint)
+        self.announce(self.p.checkpoint)
+        info("checkpoint at entry %d" % cp.entries)
+
+    def copycheckpoint(self,other):
+        """Start with other's checkpoint, if it's good for our
+        journal too -- e.g. after a fork."""
+        if not os.path.exists(other.p.checkpoint):
+            return
+        shutil.copy(other.p.checkpoint,self.p.checkpoint)
+        if not self.loadcheckpoint():
+            os.unlink(self.p.checkpoint)
+            return
+        self.announce(self.p.checkpoint)
+
+    def loadcheckpoint(self):
+        """Return the volume's checkpoint, or None if there isn't one
+        which is signed, intact, and made from the start of our
+        journal."""
+        if not os.path.exists(self.p.checkpoint):
+            return None
+        try:
+            msg = FBP.parse(open(self.p.checkpoint,'r').read())
+        except Error822, e:
+            debug("checkpoint:", e)
+            return None
+        if not HMAC.msgck(msg):
+            warn("bad HMAC on checkpoint, ignoring it")
+            return None
+        cp = Checkpoint.frommsg(msg)
+        if not cp:
+            debug("checkpoint damaged, ignoring it")
+            return None
+        index = self.journal.index()
+        if not 0 < cp.entries <= len(index) \
+                or index[cp.entries - 1].hash != cp.hash:
+            debug("checkpoint doesn't match journal, ignoring it")
+            return None
+        return cp
+
     def closefile(self,fh):
         del self.openfiles[fh]
 
@@ -591,10 +1290,23 @@ class Volume:
         Return an ordered list of the journal messages which need to be
         processed for the next update.
         """
-        done = self.history.xidlist()
-
-        msgs = self.journal.entries()
+        done = self.history.xidset()
         pending = []
+        i = 0
+        # a new host can start from a checkpoint, or pick up where
+        # it left off if it was interrupted doing so
+        cp = self.startpoint(done)
+        if cp:
+            pending = [ msg for msg in cp.snaps()
+                    if msg['xid'] not in done ]
+            pending.append(cp.msg())
+            i = cp.entries
+
+        # skip straight past what's already been applied
+        index = self.journal.index()
+        while i < len(index) and index[i].xid in done:
+            i += 1
+        msgs = self.journal.entriesfrom(i)
         for msg in msgs:
             # compare history with journal
             if msg['xid'] in done:
@@ -602,54 +1314,111 @@ class Volume:
             pending.append(msg)
         return pending
 
+    def startpoint(self,done):
+        """Return the checkpoint a host which has applied the xids in
+        done can start from, or None.  That's a host with no history,
+        or one which got partway through applying the checkpoint's
+        snaps -- replaying the journal from the top would put older
+        versions of those files back.  Unless IS_CHECKPOINT_SKIPEXEC
+        is set, it's only if there are no exec or reboot entries
+        before the checkpoint, since a host which starts there won't
+        run them."""
+        cp = self.loadcheckpoint()
+        if not cp:
+            return None
+        if done and not done.issubset(cp.xids()):
+            return None
+        if cp.execs and not os.environ.get('IS_CHECKPOINT_SKIPEXEC'):
+            debug("checkpoint skips %d execs, not using it" % cp.execs)
+            return None
+        return cp
+
     def pendingfiles(self):
         files = []
-        for msg in self.pending():
-            if not msg.type() == 'snap':
+        for (msg,later) in elide(self.pending()):
+            if later or not msg.type() == 'snap':
                 continue
             blk = msg.head.blk
             path = self.mkrelative(self.blk2path(blk))
             files.append(path)
         return files
 
-    def sums(self,path):
-        m = md5.new()
-        s = sha.new()
-        fh = open(path,'r')
-        fd = fh.fileno()
-        while True:
-            yield kernel.sigbusy
-            data = os.read(fd,8192)
-            if not data:
-                break
-            m.update(data)
-            s.update(data)
-        fh.close()
-        yield {'md5': m.hexdigest(), 'sha': s.hexdigest()}
-        return
-
-    def update(self,reboot_ok=False):
+    def snapsize(self,msg):
+        """size of the file a snap writes, or None if we can't tell
+        without fetching it"""
+        if msg.has_key('st_size'):
+            return msg.head.st_size
+        blk = msg['blk']
+        path = "%s/%s/%s" % (self.p.block,blk[:3],blk)
+        if os.path.exists(path):
+            return os.path.getsize(path)
+        return None
+
+    def report(self,plan):
+        """tell the user which snaps an update would skip"""
+        lines = []
+        nsnaps = 0
+        nskip = 0
+        saved = 0
+        unknown = 0
+        for (msg,later) in plan:
+            if msg.type() != 'snap':
+                continue
+            nsnaps += 1
+            if not later:
+                continue
+            nskip += 1
+            size = self.snapsize(msg)
+            if size is None:
+                unknown += 1
+                size = '?'
+            lines.append("skip %s %s: %s bytes, superseded by %s\n" % (
+                msg['xid'],msg['pathname'],size,later['xid']))
+            if size != '?':
+                saved += size
+        line = "%d of %d pending snaps superseded, saving %d bytes" % (
+                nskip,nsnaps,saved)
+        if unknown:
+            line += " plus %d of unknown size" % unknown
+        lines.append(line + "\n")
+        self.outpin.tx(FBP.msg('stdout',''.join(lines)))
+
+    def update(self,reboot_ok=False,dryrun=False):
         fbp = fbp822()
         if self.wip():
             error("local changes not checked in")
             return 
         info("checking for updates")
-        yield kernel.wait(self.pull())
+        # a dry run only needs the journal to see what's pending
+        yield kernel.wait(self.pull(blocks=not dryrun))
         pending = self.pending()
         if not len(pending):
             info("no new updates")
             return
-        for msg in pending:
+        plan = elide(pending)
+        if dryrun:
+            self.report(plan)
+            return
+        for (msg,later) in plan:
+            if later:
+                # nothing between here and later can see the file
+                debug("superseded:",msg['pathname'],msg['xid'])
+                self.history.add(msg)
+                continue
             debug(msg['pathname'],time.time())
             # XXX XXX XXX OUCH!!!  using 'wait' here keeps us from
             # XXX XXX XXX checking return codes; execution of journal
             # XXX XXX XXX will always continue on error
             if msg.type() == 'snap': 
-                yield kernel.wait(self.updateSnap(msg))
+                yield kernel.wait(self.updateSnap(msg),sched='bulk')
             if msg.type() == 'exec': 
                 yield kernel.wait(self.updateExec(msg))
             if msg.type() == 'reboot': 
                 yield kernel.wait(self.updateReboot(msg,reboot_ok))
+            if msg.type() == 'checkpoint': 
+                if not self.updateCheckpoint(msg):
+                    # the rest of the journal assumes the checkpoint
+                    return
         info("update done")
 
     def updateSnap(self,msg):
@@ -667,11 +1436,12 @@ class Volume:
             while not os.path.exists(src):
                 info("pull", relsrc)
                 yield kernel.wait(self.pullfiles([relsrc]))
-            sumtask = kernel.spawn(self.sums(src),itermode=True)
-            sums = None
-            for sums in sumtask: yield kernel.sigbusy
+            try:
+                sums = yield kernel.offload(filesums,src)
+            except EnvironmentError:
+                sums = None
             if not sums: 
-                error("unable to checksum",tmpfn)
+                error("unable to checksum",src)
                 yield False
                 return
             if sums['sha'] == sha1sum and sums['md5'] == md5sum:
@@ -710,7 +1480,7 @@ class Volume:
             setattr(st,attr,getattr(msg.head,attr))
         self.setstat(tmpdst,st)
         # integrity: copy to tmpdst first, then rename
-        shutil.copyfile(src,tmpdst)
+        yield kernel.offload(shutil.copyfile,src,tmpdst)
         os.rename(tmpdst,dst)
         # update history
         self.history.add(msg)
@@ -718,6 +1488,25 @@ class Volume:
         yield True
         debug("updateSnap done")
 
+    def updateCheckpoint(self,msg):
+        # the checkpoint's snaps have been applied -- if they all
+        # worked, record every entry it covers
+        cp = Checkpoint.frommsg(msg)
+        done = self.history.xidset()
+        for snap in cp.snaps():
+            if snap['xid'] not in done:
+                error("checkpoint not applied:", snap['pathname'])
+                return False
+        index = self.journal.index()
+        if len(index) < cp.entries \
+                or index[cp.entries - 1].hash != cp.hash:
+            error("journal no longer matches checkpoint")
+            return False
+        xids = [ r.xid for r in index[:cp.entries] if r.xid not in done ]
+        self.history.addxids(xids)
+        info("started from checkpoint at entry %d" % cp.entries)
+        return True
+
     def updateExec(self,msg):
         argv = msg.data().strip().split("\n")
         cwd = msg['cwd']
@@ -729,12 +1518,12 @@ class Volume:
         stdin.close()
         outputs = [stdout,stderr]
         while len(outputs):
-            yield kernel.sigbusy
+            yield kernel.sigio, outputs, []
             dead = []
             (r,w,e) = select.select(outputs,[],outputs,0)
             dead += e
             for f in r:
-                rxd = os.read(f.fileno(), 8192) 
+                rxd = os.read(f.fileno(), 65536)
                 if len(rxd) == 0:
                     dead.append(f)
                 else:
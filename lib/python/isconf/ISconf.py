@@ -25,7 +25,7 @@ from isconf.Errno import iserrno
 from isconf.Globals import *
 from isconf import ISFS
 from isconf.Kernel import kernel, Bus
-from isconf.fbp822 import fbp822, Error822
+from isconf.fbp822 import fbp822, Error822, Parser822
 from isconf.Socket import Timeout
 
 class CLIServerFactory:
@@ -47,6 +47,8 @@ class CLIServer:
         self.transport=sock
         self.verbose = False
         self.debug = False
+        # send binary frames -- set if the client says it can take them
+        self.binary = False
 
     def run(self):
         yield kernel.sigbusy 
@@ -54,7 +56,7 @@ class CLIServer:
         fbp = fbp822()
 
         # set up FBP buses
-        tocli = Bus('tocli')
+        tocli = Bus(name='tocli')
 
         # process messages from client
         proc = kernel.spawn(self.process(transport=self.transport,outpin=tocli))
@@ -64,10 +66,11 @@ class CLIServer:
         log = kernel.spawn(self.merge(tocli,BUS.log))
 
         # heartbeat to client
-        kernel.spawn(self.heartbeat(transport=self.transport))
+        kernel.spawn(self.heartbeat(transport=self.transport),
+                sched='interactive')
 
         # wait for everything to quiesce
-        yield kernel.siguntil, proc.isdone
+        yield kernel.sigwait, proc
         yield kernel.sigsleep, .1
         while True:
             yield None
@@ -98,13 +101,25 @@ class CLIServer:
                 outbus.tx(msg)
 
     def process(self,transport,outpin):
+        # one parser for the life of the connection, so a message
+        # split across reads is picked up where it left off
+        parser = Parser822()
         while True:
             yield None
+            # wait for the client to say something
+            yield transport.rxwait()
+            rxd = transport.read(65536)
+            if not rxd:
+                if transport.state == 'down':
+                    return
+                continue
             # read messages from client
-            mlist = FBP.fromFile(stream=transport)
+            try:
+                mlist = parser.feed(rxd)
+            except Error822, e:
+                error(iserrno.EBADMSG, str(e))
+                return
             for msg in mlist:
-                if msg in (kernel.eagain,None):
-                    continue
                 if outpin.state == 'down':
                     return
                 if msg is kernel.eof:
@@ -118,6 +133,7 @@ class CLIServer:
                     return
                 self.verbose = msg.head.verbose
                 self.debug = msg.head.debug
+                self.binary = msg['frames'] == 'binary'
                 data = msg.payload()
                 opt = dict(msg.items())
                 if opt['message'] == 'None':
@@ -154,7 +170,7 @@ class CLIServer:
             yield kernel.sigsleep,1
             if transport.state == 'down':
                 return
-            transport.write(str(msg))
+            msg.writeto(transport,unixfrom=True,binary=self.binary)
 
     def respond(self,transport,inpin):
         while True:
@@ -174,7 +190,8 @@ class CLIServer:
                 rectype = msg.type()
                 if rectype == 'debug' and not self.debug:
                     continue
-                transport.write(str(msg))
+                # big stdout payloads go out without being copied
+                msg.writeto(transport,unixfrom=True,binary=self.binary)
                 if msg.type() == 'rc':
                     transport.close()
                     return
@@ -239,6 +256,7 @@ class Ops:
             if not newvolume.journal.copy(self.volume.journal):
                 error("%s already exists -- did you mean 'migrate'?" % newbranch)
                 return
+            newvolume.copycheckpoint(self.volume)
             info("branch %s created" % (newbranch))
         else:
             if not self.volume.journal.migrate(newvolume.journal):
@@ -266,6 +284,10 @@ class Ops:
         debug("migrate calling fork")
         yield kernel.wait(self.fork(migrate=True))
 
+    def ps(self):
+        yield None
+        self.outpin.tx(FBP.msg('stdout',kernel.report()))
+
     def reboot(self):
         yield None
         debug("calling reboot")
@@ -313,12 +335,19 @@ class Ops:
         self.volume.unlock()
         info("broke %s lock -- please notify %s" % (self.volname,locker))
 
+    def plan(self):
+        # 'isconf -n up' -- sent as its own verb so that a daemon
+        # which doesn't know about dry runs refuses it rather than
+        # doing a real update
+        yield kernel.wait(self.volume.update(dryrun=True),sched='bulk')
+
     def up(self):
         reboot_ok = bool(self.opt.get('reboot_ok',False))
         if reboot_ok:
             debug("reboot_ok", repr(self.opt['reboot_ok']))
             info("may reboot...")
-        yield kernel.wait(self.volume.update(reboot_ok=reboot_ok))
+        yield kernel.wait(self.volume.update(reboot_ok=reboot_ok),
+                sched='bulk')
 
             
 def branch(val=None):
@@ -364,13 +393,21 @@ def client(transport,argv,kwopt):
 
     fbp = fbp822()
     verb = argv.pop(0)
+    kwopt = dict(kwopt)
+    if kwopt.pop('dryrun',False):
+        if verb != 'up':
+            return clierr(iserrno.EINVAL,"-n is only valid on up")
+        verb = 'plan'
     if len(argv):
         payload = "\n".join(argv) + "\n"
     else:
         payload = ''
     logname = os.environ['LOGNAME']
     cwd = os.getcwd()
-    msg = fbp.mkmsg('cmd',payload,verb=verb,logname=logname,cwd=cwd,**kwopt)
+    # frames: tell the server we can read binary frames -- the
+    # cmd itself goes as text, which any server understands
+    msg = fbp.mkmsg('cmd',payload,verb=verb,logname=logname,cwd=cwd,
+            frames='binary',**kwopt)
 
     # this is a blocking write...
     # XXX what happens here if daemon dies?
@@ -4,9 +4,18 @@
 # vim:set tabstop=4:
 
 from __future__ import generators
+import collections
 import copy
+import dis
+import errno
+import fcntl
+import heapq
+import math
 import os
+import Queue
+import select
 import sys
+import threading
 import time
 import traceback
 
@@ -15,6 +24,23 @@ from isconf.Globals import *
 class Deadlock(Exception): pass
 class Restart(Exception): pass
 
+class Signal(object):
+    """A kernel signal, yielded by a task either alone or as the
+    first item of a tuple.  Signals are compared by identity, so
+    each one must be a unique object.
+
+    >>> kernel.sigsleep
+    <signal sleep>
+
+    """
+    __slots__ = ('name',)
+
+    def __init__(self,name):
+        self.name = name
+
+    def __repr__(self):
+        return "<signal %s>" % self.name
+
 class Bus:
     """
     
@@ -61,49 +87,149 @@ class Bus:
     >>> kernel.run(steps=100)
     >>> r.next()
     'EAGAIN'
+
+    If maxlen is set, no reader will ever have more than maxlen
+    messages queued.  With overflow='block' (the default), tx()
+    refuses the message and returns False until every reader has
+    room; writers can yield txwait() to sleep until then.  With
+    overflow='drop', each reader's queue is a ring buffer which
+    discards the oldest message instead.
+
+    >>> def consumer(inpin):
+    ...     while True:
+    ...         mlist = []
+    ...         yield inpin.rx(mlist,count=1)
+    ...         print "got", mlist[0]
+    >>> def producer(outpin):
+    ...     for i in range(5):
+    ...         while not outpin.tx(i):
+    ...             print "blocked at", i
+    ...             yield outpin.txwait()
+    >>> bounded = Bus(maxlen=2)
+    >>> c = kernel.spawn(consumer(bounded))
+    >>> p = kernel.spawn(producer(bounded))
+    blocked at 3
+    >>> kernel.run(steps=100)
+    got 0
+    blocked at 4
+    got 1
+    got 2
+    got 3
+    got 4
+    >>> ring = Bus(maxlen=2,overflow='drop')
+    >>> r = kernel.spawn(ring.reader(),itermode=True)
+    >>> r.next()
+    'EAGAIN'
+    >>> for i in range(5):
+    ...     assert ring.tx(i)
+    >>> got = []
+    >>> for i in range(5):
+    ...     kernel.run(steps=10)
+    ...     got.append(r.next())
+    >>> got
+    [0, 1, 3, 4, 'EAGAIN']
     
     """
     
-    def __init__(self,maxlen=None,minreaders=1,name=None):
+    def __init__(self,maxlen=None,minreaders=1,name=None,overflow='block'):
+        assert overflow in ('block','drop')
         self.maxlen = maxlen
+        self.overflow = overflow
         # all reader queues, indexed by task id
         self.readq = {}
+        # readers blocked in rx(), indexed by task id -- each entry
+        # is [buf, expires, count, given]
+        self.waiting = {}
+        # writers parked in txwait()
+        self.txwaiters = []
         self.minreaders = minreaders
         self.name = name
         self.state = 'up'
     
     def busy(self):
-        self.clean()
         for (tid,queue) in self.readq.items():
             if len(queue):
                 return True
         return False
 
     def clean(self):
+        # the kernel unsubscribes tasks as they exit, so this should
+        # never find anything
         for (tid,queue) in self.readq.items():
             if not kernel.isrunning(tid):
-                del self.readq[tid]
+                self.unsubscribe(tid)
 
     def close(self):
         self.state = 'down'
+        # let blocked readers see EOF
+        for tid in self.waiting.keys():
+            kernel.wake(tid)
+        kernel.wakeall(self.txwaiters)
 
     def subscribe(self,tid):
         """Create a readers queue for tid.  Called by kernel."""
-        self.readq.setdefault(tid,[])
+        if not self.readq.has_key(tid):
+            if self.overflow == 'drop' and self.maxlen:
+                self.readq[tid] = collections.deque([],self.maxlen)
+            else:
+                self.readq[tid] = collections.deque()
+            # a writer might be waiting for minreaders
+            kernel.wakeall(self.txwaiters)
+
+    def unsubscribe(self,tid):
+        """Drop tid's queue.  Called by kernel when tid exits."""
+        if self.readq.has_key(tid):
+            del self.readq[tid]
+            kernel.wakeall(self.txwaiters)
+        if self.waiting.has_key(tid):
+            del self.waiting[tid]
+
+    def _handoff(self,tid):
+        # return the wait list entry if tid is blocked in rx() and
+        # has room for another message in its buffer
+        wait = self.waiting.get(tid,None)
+        if wait is None:
+            return None
+        room = wait[2]
+        if self.maxlen:
+            room = min(room,self.maxlen)
+        if wait[3] < room:
+            return wait
+        return None
 
     def tx(self,msg):
         if self.state == 'down':
             return 0
-        self.clean()
         i = len(self.readq) # number of subscribed readers
         if i < self.minreaders:
             return False
+        maxlen = self.maxlen
+        if maxlen and self.overflow == 'block':
+            # all or nothing -- don't queue to anyone unless everyone
+            # has room
+            for (tid,queue) in self.readq.items():
+                if len(queue) >= maxlen and not self._handoff(tid):
+                    return False
         for (tid,queue) in self.readq.items():
-            if self.maxlen and len(queue) + 1 > self.maxlen:
-                raise Deadlock  # XXX need some id here
+            wait = self._handoff(tid)
+            if wait:
+                # reader is blocked and its queue is empty -- hand
+                # the message straight over and wake it up
+                wait[0].append(msg)
+                wait[3] += 1
+                if wait[3] == 1:
+                    kernel.wake(tid)
+                continue
             queue.append(msg)
         return i
 
+    def txwait(self):
+        """Returns a signal for a writer to yield after tx() fails;
+        the writer sleeps until a reader makes room or subscribes."""
+        if self.state == 'down':
+            return None
+        return kernel.sigpark, self.txwaiters
+
     def reader(self):
         """convenience generator -- read bus while not in a task"""
         while True:
@@ -115,22 +241,49 @@ class Bus:
     def writer(self,msg):
         """convenience generator -- reliable tx"""
         while not self.tx(msg):
-            yield None
+            yield self.txwait()
     
     def ready(self,tid,buf,expires,count):
-        if len(self.readq[tid]):
-            c = min(len(self.readq[tid]), count)
-            buf += self.readq[tid][:c]
-            self.readq[tid] = self.readq[tid][c:]
+        queue = self.readq[tid]
+        if queue:
+            c = min(len(queue), count)
+            popleft = queue.popleft
+            for i in xrange(c):
+                buf.append(popleft())
+            if self.txwaiters:
+                kernel.wakeall(self.txwaiters)
             return True
         if self.state == 'down':
             buf.append(kernel.eof)
             return True
-        if (expires is not None) and time.time() > expires:
+        if (expires is not None) and time.time() >= expires:
             buf.append(kernel.eagain)
             return True
         return False
 
+    def rxwait(self,tid,buf,expires,count):
+        """Called by kernel when tid yields rx().  Fills buf and
+        returns True if anything is ready now, otherwise puts tid on
+        the wait list and returns False; tx() will wake it up."""
+        self.subscribe(tid)
+        if self.ready(tid,buf,expires,count):
+            return True
+        self.waiting[tid] = [buf,expires,count,0]
+        return False
+
+    def rxdone(self,tid):
+        """Called by kernel when a reader on the wait list is woken.
+        Returns True if it got something, and takes it off the wait
+        list."""
+        wait = self.waiting.get(tid,None)
+        if wait is None:
+            return True
+        (buf,expires,count,given) = wait
+        if not given and not self.ready(tid,buf,expires,count):
+            return False
+        del self.waiting[tid]
+        return True
+
     def rx(self,buf,timeout=None,count=999999):
         """
 
@@ -155,6 +308,23 @@ class Bus:
         1 [1]
         1 [2]
         1 [3]
+        >>> def impatient(inpin):
+        ...     mlist = []
+        ...     yield inpin.rx(mlist,timeout=.1)
+        ...     print mlist
+        >>> kernel.run(impatient(Bus()))
+        ['EAGAIN']
+
+        Readers are unsubscribed as soon as they exit:
+
+        >>> bus2 = Bus()
+        >>> t = kernel.spawn(impatient(bus2))
+        >>> bus2.tx('once')
+        1
+        >>> kernel.run(steps=10)
+        ['once']
+        >>> bus2.tx('twice')
+        False
 
         """
         expires = None
@@ -207,22 +377,78 @@ class Kernel:
 
     """
 
-    # XXX yield should return object rather than string
-    sigrx='rx'
-    sigbusy='busy'
-    signice='nice'
-    sigret='ret'
-    sigsleep='sleep'
-    sigspawn='spawn'
-    siguntil='until'
+    sigrx = Signal('rx')
+    sigbusy = Signal('busy')
+    sigio = Signal('io')
+    sigoffload = Signal('offload')
+    sigpark = Signal('park')
+    sigret = Signal('ret')
+    sigsched = Signal('sched')
+    sigsleep = Signal('sleep')
+    sigspawn = Signal('spawn')
+    siguntil = Signal('until')
+    sigwait = Signal('wait')
     eagain = 'EAGAIN'
     eof = 'EOF'
 
     def __init__(self):
         self._tasks = {}
         self._nextid = 1
-        self.HZ = 1000
         self._shutdown = False
+        # scheduling classes, and how many steps each one gets per
+        # pass through the run queues -- see run()
+        self.classes = {'interactive': 16, 'network': 8, 'bulk': 4}
+        # class for tasks spawned from outside any task
+        self.defaultclass = 'network'
+        # task being stepped right now, if any
+        self._current = None
+        # tasks which are ready to be stepped, a FIFO per class
+        self._runq = {}
+        for sched in self.classes:
+            self._runq[sched] = collections.deque()
+        # total number of tasks on all run queues
+        self._nready = 0
+        # heap of (expiry time, sequence, Timer) -- see timer()
+        self._timers = []
+        self._timerseq = 0
+        # number of timers in the heap which haven't been cancelled
+        self._timerslive = 0
+        # tasks blocked in select(), indexed by task id
+        self._io = {}
+        # tasks blocked on an arbitrary siguntil condition -- these
+        # are the only blocked tasks we still have to poll
+        self._polled = {}
+        # how often to poll siguntil conditions when otherwise idle
+        self.pollinterval = .1
+        # profiling totals for tasks which have exited, by name
+        self.exited = {}
+        # watchdog -- steps taking longer than slowstep seconds get
+        # logged, and the worst maxslow of them are kept in slowsteps,
+        # a heap with the shortest on top
+        self.slowstep = .25
+        self.slowsteps = []
+        self.maxslow = 32
+        # worker threads for offload(), started on first use
+        self.workers = 4
+        self._pool = None
+        # how to wait for file descriptors -- 'epoll', 'poll',
+        # 'select', or None for the best one available; see mkpoller()
+        self.pollmethod = None
+        self.poller = None
+        # step() looks up handlers by signal identity
+        self._dispatch = {
+            self.sigbusy: self._sigbusy,
+            self.sigio: self._sigio,
+            self.sigoffload: self._sigoffload,
+            self.sigpark: self._sigpark,
+            self.sigret: self._sigret,
+            self.sigrx: self._sigrx,
+            self.sigsched: self._sigsched,
+            self.sigsleep: self._sigsleep,
+            self.sigspawn: self._sigspawn,
+            self.siguntil: self._siguntil,
+            self.sigwait: self._sigwait,
+        }
 
     def isdone(self,tid):
         return not self.isrunning(tid)
@@ -232,8 +458,22 @@ class Kernel:
 
     def kill(self,tid):
         debug("killing", tid)
+        task = self._tasks.get(tid,None)
         self._tasks.setdefault(tid,None)
         del self._tasks[tid]
+        if self._polled.has_key(tid):
+            del self._polled[tid]
+        if self._io.has_key(tid):
+            del self._io[tid]
+        if task:
+            self._exitstats(task)
+            for bus in task.buses:
+                bus.unsubscribe(tid)
+            if task.timer:
+                task.timer.cancel()
+            # let anyone waiting on us know we're done
+            for waiter in task.waiters:
+                self.wake(waiter)
 
     def abort(self,task,e):
         tid = task.tid
@@ -257,6 +497,11 @@ class Kernel:
         for tid in tids:
             self.kill(tid)
         self._tasks = {}
+        for q in self._runq.values():
+            q.clear()
+        self._nready = 0
+        self._timers = []
+        self._timerslive = 0
 
     def shutdown(self):
         debug("shutting down")
@@ -264,14 +509,125 @@ class Kernel:
 
     def ps(self):
         return self._tasks
-        # XXX
-        out = ''
-        for id in self._tasks.keys():
-            task = self._tasks[id]
-            out += str(task) + "\n"
+
+    def report(self):
+        """Return a table of per-task profiling counters, busiest
+        tasks first:  number of steps, total and longest time spent
+        in a single step, what the task is waiting for now, and how
+        long it has spent waiting for each reason.  Exited tasks are
+        totalled by name at the end.
+
+        >>> def nap():
+        ...     yield None
+        ...     yield kernel.sigsleep, .1
+        >>> task = kernel.spawn(nap(),name='napper')
+        >>> while kernel.isrunning(task.tid):
+        ...     kernel.run(steps=1)
+        >>> task.steps
+        3
+        >>> assert task.waits['sleep'] >= .1
+        >>> assert task.cputime < task.waits['sleep']
+        >>> kernel.exited['napper']['steps']
+        3
+        >>> 'napper' in kernel.report()
+        True
+
+        """
+        now = time.time()
+        fmt = "%6s %-24s %-11s %8s %9s %8s %-8s %s\n"
+        out = fmt % ('TID','NAME','CLASS','STEPS','CPU','MAXSTEP','WCHAN',
+                'WAITS')
+        tasks = [ (-t.cputime,t.tid,t) for t in self._tasks.values() ]
+        tasks.sort()
+        for (cpu,tid,task) in tasks:
+            waits = task.waits.copy()
+            if task.wchan:
+                waits[task.wchan] = \
+                    waits.get(task.wchan,0) + now - task.waitStart
+            out += fmt % (tid, task.label()[:24], task.sched, task.steps,
+                "%.3f" % task.cputime, "%.3f" % task.maxstep,
+                task.wchan or '-', _fmtwaits(waits))
+        if self.exited:
+            out += "\nexited:\n"
+            out += fmt % ('COUNT','NAME','','STEPS','CPU','MAXSTEP','',
+                    'WAITS')
+            names = [ (-s['cputime'],name) for (name,s) in self.exited.items() ]
+            names.sort()
+            for (cpu,name) in names:
+                s = self.exited[name]
+                out += fmt % (s['count'], name[:24], '', s['steps'],
+                    "%.3f" % s['cputime'], "%.3f" % s['maxstep'],
+                    '', _fmtwaits(s['waits']))
+        if self.slowsteps:
+            out += "\nslow steps:\n"
+            slow = list(self.slowsteps)
+            slow.sort()
+            slow.reverse()
+            for (elapsed,when,tid,name,where) in slow:
+                out += "%8.3f %s %6d %-24s %s\n" % (elapsed,
+                    time.strftime("%H:%M:%S",time.localtime(when)),
+                    tid, name[:24], where)
         return out
 
-    def wait(self,genobj):
+    def _slow(self,task,elapsed,code,lasti):
+        """Watchdog:  note a step which held the CPU too long, and
+        where in the generator it started and stopped.
+
+        >>> def hog():
+        ...     time.sleep(.05)
+        ...     yield None
+        >>> kernel.slowstep = .01
+        >>> t = kernel.spawn(hog(),name='hog')
+        >>> kernel.slowstep = .25
+        >>> (elapsed,when,tid,name,where) = max(kernel.slowsteps)
+        >>> assert elapsed >= .05
+        >>> name
+        'hog'
+        >>> where.endswith(":1-3")
+        True
+
+        Only the worst are kept, however many lesser ones come after:
+
+        >>> def nap(secs):
+        ...     time.sleep(secs)
+        ...     yield None
+        >>> (slowsteps, kernel.slowsteps) = (kernel.slowsteps, [])
+        >>> (kernel.slowstep, kernel.maxslow) = (.01, 3)
+        >>> for secs in (.1, .03, .02, .02, .02, .02):
+        ...     t = kernel.spawn(nap(secs),name='nap')
+        >>> len(kernel.slowsteps), max(kernel.slowsteps)[0] >= .1
+        (3, True)
+        >>> (kernel.slowstep, kernel.maxslow) = (.25, 32)
+        >>> kernel.slowsteps = slowsteps
+
+        """
+        where = "%s:%d-" % (code.co_filename,_lineno(code,lasti))
+        frame = task.obj.gi_frame
+        if frame is None:
+            where += "exit"
+        else:
+            where += str(frame.f_lineno)
+        slow = (elapsed,time.time(),task.tid,task.label(),where)
+        if len(self.slowsteps) < self.maxslow:
+            heapq.heappush(self.slowsteps,slow)
+        else:
+            heapq.heappushpop(self.slowsteps,slow)
+        debug("kernel: slow step: %.3fs in task %d %s at %s" % 
+                (elapsed,task.tid,task.label(),where))
+
+    def _exitstats(self,task):
+        task.unblock(time.time())
+        s = self.exited.setdefault(task.label(),
+            {'count': 0, 'steps': 0, 'cputime': 0.0, 'maxstep': 0.0,
+             'waits': {}})
+        s['count'] += 1
+        s['steps'] += task.steps
+        s['cputime'] += task.cputime
+        s['maxstep'] = max(s['maxstep'],task.maxstep)
+        for (wchan,secs) in task.waits.items():
+            s['waits'][wchan] = s['waits'].get(wchan,0) + secs
+
+    def wait(self,genobj,sched=None):
         """Spawn a task and wait for it to finish.  For example, if
         you do:
         
@@ -280,10 +636,120 @@ class Kernel:
         ...the yield will not return until sometask() completes.
 
         """
-        return self.siguntil, self.spawn(genobj).isdone
+        return self.sigwait, self.spawn(genobj,sched=sched)
+
+    def offload(self,func,*args):
+        """Run func(*args) in a worker thread, so blocking calls and
+        CPU-heavy work don't stall every other task.  Yield the
+        return value; the yield returns func's result, or raises
+        whatever func raised:
+
+            data = yield kernel.offload(open(path).read)
+
+        func runs right away, in parallel with the calling task, but
+        must not touch kernel state -- no Bus.tx(), no spawn(), and
+        no logging.
+
+        >>> def adder(a,b):
+        ...     return a + b
+        >>> def user():
+        ...     total = yield kernel.offload(adder,2,3)
+        ...     print "got", total
+        ...     try:
+        ...         yield kernel.offload(int,'x')
+        ...     except ValueError, e:
+        ...         print "caught", e
+        >>> kernel.run(user())
+        got 5
+        caught invalid literal for int() with base 10: 'x'
+
+        """
+        if self._pool is None:
+            self._pool = Pool(self.workers)
+        future = Future(func,args)
+        self._pool.put(future)
+        return self.sigoffload, future
+
+    def wake(self,tid):
+        """Put a blocked task back on the run queue.  
+        
+        Whatever the task was waiting for gets checked again before
+        the task is stepped, so waking a task which isn't really
+        ready yet is harmless; tasks waiting on sigio or sigpark are
+        released unconditionally.
+        
+        """
+        task = self._tasks.get(tid,None)
+        if task:
+            self._ready(task)
+
+    def wakeall(self,waitlist):
+        """Wake every task parked on waitlist, and empty it."""
+        for tid in waitlist:
+            self.wake(tid)
+        del waitlist[:]
+
+    def _ready(self,task):
+        if not task.queued:
+            task.queued = True
+            self._runq[task.sched].append(task)
+            self._nready += 1
+
+    def timer(self,secs,func,*args):
+        """Call func(*args) from the kernel loop after secs seconds.
+        Returns a Timer; call its cancel() method if you change your
+        mind.
+
+        >>> def ding(msg):
+        ...     print msg
+        >>> t1 = kernel.timer(.2,ding,'second')
+        >>> t2 = kernel.timer(.1,ding,'first')
+        >>> t3 = kernel.timer(.15,ding,'never')
+        >>> t3.cancel()
+        >>> def idle():
+        ...     yield kernel.sigsleep, .3
+        >>> kernel.run(idle())
+        first
+        second
+
+        """
+        timer = Timer(time.time() + secs,func,args)
+        self._timerseq += 1
+        heapq.heappush(self._timers,(timer.when,self._timerseq,timer))
+        self._timerslive += 1
+        return timer
+
+    def _timeout(self,task,secs):
+        """wake task after secs seconds unless it wakes up first"""
+        if task.timer:
+            task.timer.cancel()
+        task.timer = self.timer(secs,self.wake,task.tid)
+
+    def _expire(self):
+        """run due timers, return seconds until the next one"""
+        timers = self._timers
+        # cancelled timers are left in the heap until they get to
+        # the top, unless they start to pile up
+        if len(timers) > 64 and self._timerslive < len(timers) / 2:
+            timers = [ t for t in timers if not t[2].cancelled ]
+            heapq.heapify(timers)
+            self._timers = timers
+        now = time.time()
+        while timers:
+            (when,seq,timer) = timers[0]
+            if timer.cancelled:
+                heapq.heappop(timers)
+                continue
+            if when > now:
+                return when - now
+            heapq.heappop(timers)
+            timer.cancelled = True
+            self._timerslive -= 1
+            timer.func(*timer.args)
+        return None
 
     # XXX add respawn flag, only raise Restart if not set
-    def spawn(self,genobj,itermode=False,name=None):
+    def spawn(self,genobj,itermode=False,name=None,sched=None):
         """
         Let the kernel manage an ordinary generator object by wrapping
         it in a Task -- extremely powerful, because this means a yield
@@ -300,6 +766,9 @@ class Kernel:
         thing the caller needs to know is that if there is no result
         ready, then you will get a kernel.eagain result instead.  
 
+        sched is the task's scheduling class (see run()); by default
+        a task is in the same class as the task which spawned it.
+
         >>> def mygen():
         ...     i = 0
         ...     while True:
@@ -341,7 +810,15 @@ class Kernel:
         
         """
 
+        if sched is None:
+            if self._current:
+                sched = self._current.sched
+            else:
+                sched = self.defaultclass
+        if not self.classes.has_key(sched):
+            raise Exception("unknown scheduling class: %s" % sched)
         task = Task(genobj,tid=self._nextid,name=name)
+        task.sched = sched
         tid = task.tid
         assert tid == self._nextid
         self._nextid += 1
@@ -356,135 +833,623 @@ class Kernel:
     def run(self, initobj=None, steps=None):
         """
         runs for {steps} or until init task is done
-        
+
+        Each time through the loop, every task on the run queue gets
+        stepped once.  Blocked tasks -- sleeping, reading from an
+        empty Bus, waiting on a file descriptor or on another task --
+        are not on the run queue, and are not looked at again until
+        a timer, a Bus.tx(), select(), or kernel.wake() puts them
+        back; an idle kernel just sits in select() until the next
+        timer is due.  Only siguntil conditions still need polling.
+
+        Each task is in a scheduling class -- interactive, network
+        or bulk -- with its own run queue.  A pass steps up to
+        self.classes[sched] tasks from each class's queue, in FIFO
+        order, so when everyone is busy the classes share steps in
+        proportion to their weights.  Because every class with
+        runnable tasks gets stepped on every pass, and a pass is at
+        most sum(self.classes.values()) steps, no class can starve
+        another: a heartbeat woken behind hundreds of bulk tasks
+        still runs within one pass.
+
+        In steps mode we never block, so each step is one pass
+        through the run queues.
+
+        >>> def worker(sched,log):
+        ...     while True:
+        ...         log.append(sched)
+        ...         yield kernel.sigbusy
+        >>> log = []
+        >>> for i in range(20):
+        ...     t = kernel.spawn(worker('bulk',log),sched='bulk')
+        >>> ui = kernel.spawn(worker('interactive',log),sched='interactive')
+        >>> del log[:]
+        >>> kernel.run(steps=1)
+        >>> log.count('interactive'), log.count('bulk')
+        (1, 4)
+        >>> del log[:]
+        >>> kernel.run(steps=10)
+        >>> log.count('interactive'), log.count('bulk')
+        (10, 40)
+        >>> kernel.killall()
+
+        >>> def napper(secs):
+        ...     yield kernel.sigsleep, secs
+        ...     print "slept", secs
+        >>> def waiter():
+        ...     yield kernel.wait(napper(.1))
+        ...     print "done waiting"
+        >>> start = time.time()
+        >>> kernel.run(waiter())
+        slept 0.1
+        done waiting
+        >>> assert .1 <= time.time() - start < .5
+
         """
         assert initobj or steps
-        if initobj and not self.isrunning(1): 
-            self.spawn(initobj)
+        if initobj:
+            init = self.spawn(initobj)
         ticks = 0
         while True:
             if self._shutdown:
                 sys.exit(0)
-            if initobj and not self.isrunning(1): break
+            if initobj and not self.isrunning(init.tid): break
             if steps and steps <= ticks: 
                 break
             ticks += 1
-            # print self.HZ
-            time.sleep(1/self.HZ)
-            if not steps:
-                self.HZ *= .99
-            self.HZ = max(self.HZ,1)
-            self.HZ = min(self.HZ,999999)
-            # if self.HZ < 100:
-            #     debug("HZ", self.HZ) 
-            for tid in self._tasks.keys():
-                task = self._tasks[tid]
-                task.priority = min(task.priority, 10)
-                # wait for N ticks if delay is set
-                if task.delay > 1:
-                    task.delay -= 1
-                    continue
-                task.delay += task.priority
-                if task.sleep and task.sleepDone > time.time():
-                    # slow down so we don't beat up time()
-                    # XXX we can do a better job here -- use HZ and
-                    # sleepDone to calculate delay more accurately
-                    task.priority += 1
-                    continue
-                task.sleep = None
-                # wait until condition is met
-                if task.until:
-                    done=False
-                    try:
-                        if isinstance(task.untilArgs,list) or \
-                               isinstance(task.untilArgs,tuple):
-                            done = task.until(*task.untilArgs)
-                        elif task.untilArgs:
-                            done = task.until(task.untilArgs)
-                        else:
-                            done = task.until()
-                    except Exception, e:
-                        # XXX add traceback
-                        self.abort(task,e)
+            self._poll(block=not steps)
+            # biggest share first
+            classes = [ (-share,sched) for (sched,share) in self.classes.items() ]
+            classes.sort()
+            for (share,sched) in classes:
+                share = -share
+                runq = self._runq[sched]
+                # tasks requeued during this pass wait for the next
+                for i in xrange(min(share,len(runq))):
+                    task = runq.popleft()
+                    self._nready -= 1
+                    task.queued = False
+                    if self._tasks.get(task.tid,None) is not task:
+                        # killed while on the run queue
                         continue
-                    if not done:
-                        # slow down so we don't beat up until()
-                        task.priority += 1
+                    if not self._runnable(task):
                         continue
-                task.until = None
-                if task.itermode and task.resultReady:
-                    # we're waiting for Task.next() to pick up our
-                    # previous result
-                    task.priority += 1
-                    continue
-                self.step(task)
+                    self.step(task)
+
+    def _poll(self,block):
+        """Wake up tasks whose timers have expired or whose file
+        descriptors are ready.  If block is set and nothing is
+        runnable, wait in self.poller until something is."""
+        timeout = 0
+        if block and not self._nready:
+            timeout = None
+            if self._polled:
+                timeout = self.pollinterval
+            due = self._expire()
+            if self._nready:
+                timeout = 0
+            elif due is not None and (timeout is None or due < timeout):
+                timeout = due
+        # build fd maps from tasks blocked in sigio
+        rmap = {}
+        wmap = {}
+        files = {}
+        pool = self._pool
+        if pool is not None and pool.pending:
+            # worker threads write to this pipe when they finish
+            rmap[pool.rfd] = []
+            files[pool.rfd] = pool.rfd
+        for task in self._io.values():
+            (rlist,wlist) = task.io
+            try:
+                for f in rlist:
+                    fd = _fileno(f)
+                    rmap.setdefault(fd,[]).append(task)
+                    files[fd] = f
+                for f in wlist:
+                    fd = _fileno(f)
+                    wmap.setdefault(fd,[]).append(task)
+                    files[fd] = f
+            except Exception, e:
+                # closed file -- let the task find out for itself
+                self._ready(task)
+                timeout = 0
+        if rmap or wmap:
+            if self.poller is None:
+                self.poller = mkpoller(self.pollmethod)
+            try:
+                (readable, writeable) = \
+                    self.poller.poll(rmap.keys(),wmap.keys(),files,timeout)
+            except (select.error, EnvironmentError, ValueError), e:
+                if e.args and e.args[0] == errno.EINTR:
+                    readable = writeable = []
+                else:
+                    # bad fd somewhere -- wake everyone, let them sort it out
+                    readable = rmap.keys()
+                    writeable = wmap.keys()
+            # errors and hangups show up on both lists
+            for fd in readable:
+                for task in rmap.get(fd,()):
+                    self._ready(task)
+            for fd in writeable:
+                for task in wmap.get(fd,()):
+                    self._ready(task)
+        elif timeout:
+            time.sleep(timeout)
+        elif timeout is None:
+            # nothing can ever wake anyone up
+            raise Deadlock("all tasks blocked")
+        if pool is not None:
+            for future in pool.reap():
+                if future.tid is not None:
+                    self.wake(future.tid)
+        self._expire()
+        # give siguntil conditions another look
+        for task in self._polled.values():
+            self._ready(task)
+
+    def _runnable(self,task):
+        """Check whether a task taken off the run queue is really
+        ready to go; if not, it goes back to waiting for whatever
+        it was waiting for."""
+        if task.sleep:
+            if task.sleepDone > time.time():
+                return False
+            task.sleep = None
+        # wait until condition is met
+        if task.until:
+            done=False
+            try:
+                if isinstance(task.untilArgs,list) or \
+                       isinstance(task.untilArgs,tuple):
+                    done = task.until(*task.untilArgs)
+                elif task.untilArgs:
+                    done = task.until(task.untilArgs)
+                else:
+                    done = task.until()
+            except Exception, e:
+                # XXX add traceback
+                self.abort(task,e)
+                return False
+            if not done:
+                return False
+            task.until = None
+            if self._polled.has_key(task.tid):
+                del self._polled[task.tid]
+        if task.future is not None and not task.future.done:
+            return False
+        if task.itermode and task.resultReady:
+            # we're waiting for Task.next() to pick up our
+            # previous result
+            if task.wchan != 'itermode':
+                task.block('itermode',time.time())
+            return False
+        if task.wchan:
+            task.unblock(time.time())
+        if task.io is not None:
+            # woken by select(), a timeout, or kernel.wake()
+            task.io = None
+            if self._io.has_key(task.tid):
+                del self._io[task.tid]
+        if task.timer:
+            task.timer.cancel()
+            task.timer = None
+        return True
 
     def step(self,task):
         obj = task.obj
         tid = task.tid
         # debug("stepping task", tid)
+        # remember where we resume from, for the watchdog
+        frame = obj.gi_frame
+        if frame is not None:
+            lasti = frame.f_lasti
+        current = self._current
+        self._current = task
+        start = time.time()
         try:
-            argv = obj.next()
+            try:
+                future = task.future
+                if future is None:
+                    argv = obj.next()
+                else:
+                    # resume with the result of kernel.offload()
+                    task.future = None
+                    if future.exc_info:
+                        argv = obj.throw(*future.exc_info)
+                    else:
+                        argv = obj.send(future.value)
+            finally:
+                self._current = current
+                now = time.time()
+                elapsed = now - start
+                task.steps += 1
+                task.cputime += elapsed
+                if elapsed > task.maxstep:
+                    task.maxstep = elapsed
+                if elapsed > self.slowstep and frame is not None:
+                    self._slow(task,elapsed,frame.f_code,lasti)
         except StopIteration:
             self.kill(tid)
             return
         except ValueError, e:
-            if e == 'generator already executing':
+            if str(e) == 'generator already executing':
                 # kernel.run() is nested -- that's okay to do
+                self._ready(task)
                 return
             raise
         except Exception, e:
             # XXX add traceback
             self.abort(task,e)
             return
-        # figure out why task yielded and what it wants
-        targv = argv
-        if not isinstance(targv,tuple):
-            targv = (targv,)
-        if targv:
-            why = targv[0]
-        if why != self.sigsleep and why != None:
-            # print "why",why
-            self.HZ *= 10
-        sigargs = None
-        if len(targv) > 1:
-            sigargs = targv[1:]
-        # XXX these should all be 'is' rather than '=='
-        if why == self.sigbusy:
-            task.nice -= 1
-            if task.nice < 0: 
-                task.nice = 0
-        elif why == self.signice:
-            task.nice = sigargs[0]
-        elif why == self.sigsleep:
-            task.sleep = sigargs[0]
-            task.sleepDone = time.time() + task.sleep
-        elif why == self.sigspawn:
-            genobj = sigargs[0]
-            spawnargs = None
-            if len(sigargs) > 0:
-                spawnargs = sigargs[1:]
-            self.spawn(genobj)
-        elif why == self.siguntil:
-            task.until = sigargs[0]
-            if len(sigargs) > 1:
-                task.untilArgs = sigargs[1:]
-            else:
-                task.untilArgs = None
-        elif why == self.sigrx:
-            bus = sigargs[0]
-            buf = sigargs[1]
-            args = sigargs[2:]
-            task.until = bus.ready
-            task.untilArgs = [tid,buf] + list(args)
-            bus.subscribe(tid)
-        elif why == self.sigret:
-            task.context.ret()
+        # figure out why task yielded and what it wants -- each
+        # handler returns the wait channel the task is now blocked
+        # on, or None if it can be stepped again right away
+        if argv is self.sigbusy:
+            wchan = None
+        elif argv.__class__ is tuple and argv and argv[0].__class__ is Signal:
+            wchan = self._dispatch[argv[0]](task,argv)
+        elif argv.__class__ is Signal:
+            wchan = self._dispatch[argv](task,(argv,))
         else:
             # we got an ordinary value back -- save it for itermode
             task.result = argv
             task.resultReady = True
-        task.priority = (task.priority + task.nice) / 2
+            wchan = None
+            if task.itermode:
+                # Task.next() will wake us
+                wchan = 'itermode'
+        if wchan:
+            task.block(wchan,now)
+        elif self._tasks.has_key(tid):
+            self._ready(task)
+
+    # signal handlers -- see step()
+
+    def _sigbusy(self,task,argv):
+        return None
+
+    def _sigsched(self,task,argv):
+        sched = argv[1]
+        if self.classes.has_key(sched):
+            task.sched = sched
+        else:
+            error("kernel: unknown scheduling class:", sched)
+        return None
+
+    def _sigsleep(self,task,argv):
+        task.sleep = argv[1]
+        task.sleepDone = time.time() + task.sleep
+        self._timeout(task,task.sleep)
+        return 'sleep'
+
+    def _sigspawn(self,task,argv):
+        self.spawn(argv[1])
+        return None
+
+    def _siguntil(self,task,argv):
+        task.until = argv[1]
+        if len(argv) > 2:
+            task.untilArgs = argv[2:]
+        else:
+            task.untilArgs = None
+        # _poll() will put us back on the run queue
+        self._polled[task.tid] = task
+        return 'until'
+
+    def _sigrx(self,task,argv):
+        (sig,bus,buf,expires,count) = argv
+        if bus not in task.buses:
+            task.buses.append(bus)
+        if bus.rxwait(task.tid,buf,expires,count):
+            return None
+        # bus.tx() or bus.close() will wake us
+        task.until = bus.rxdone
+        task.untilArgs = [task.tid]
+        if expires is not None:
+            self._timeout(task,expires - time.time())
+        return 'rx'
+
+    def _sigio(self,task,argv):
+        task.io = (argv[1],argv[2])
+        self._io[task.tid] = task
+        if len(argv) > 3 and argv[3] is not None:
+            self._timeout(task,argv[3])
+        return 'io'
+
+    def _sigpark(self,task,argv):
+        argv[1].append(task.tid)
+        if len(argv) > 2 and argv[2] is not None:
+            self._timeout(task,argv[2])
+        return 'park'
+
+    def _sigoffload(self,task,argv):
+        future = argv[1]
+        future.tid = task.tid
+        task.future = future
+        if future.done:
+            return None
+        return 'offload'
+
+    def _sigwait(self,task,argv):
+        child = argv[1]
+        if child.isdone():
+            return None
+        task.until = child.isdone
+        task.untilArgs = None
+        # the child wakes us when it exits
+        child.waiters.append(task.tid)
+        return 'wait'
+
+    def _sigret(self,task,argv):
+        task.context.ret()
+        return None
+
+class Timer:
+    """A pending kernel.timer() callback."""
+
+    def __init__(self,when,func,args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            kernel._timerslive -= 1
+
+class Future:
+    """A callable handed to kernel.offload(), and its outcome."""
+
+    def __init__(self,func,args):
+        self.func = func
+        self.args = args
+        self.done = False
+        self.value = None
+        self.exc_info = None
+        # task to wake when we're done
+        self.tid = None
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+        self.done = True
+
+class Pool:
+    """Worker threads for kernel.offload().  Finished futures are
+    queued in self.done, and a byte is written to a pipe so the
+    kernel's select() wakes up.
+
+    A worker queues its future before it writes its byte, so a byte
+    can turn up after its future has already been reaped.  reap()
+    empties the pipe every time, or a stray byte would leave the pipe
+    readable and the kernel spinning until the next job finished:
+
+    >>> k = Kernel()
+    >>> k._pool = pool = Pool(1)
+    >>> gate = threading.Event()
+    >>> pool.put(Future(gate.wait,()))
+    >>> n = os.write(pool.wfd,'.')
+    >>> timer = k.timer(.5,len,'')
+    >>> k._poll(True)
+    >>> start = time.time()
+    >>> k._poll(True)
+    >>> time.time() - start > .3
+    True
+    >>> gate.set()
+    >>> while not pool.done: time.sleep(.01)
+    >>> (len(pool.reap()), pool.pending)
+    (1, 0)
+
+    """
+
+    def __init__(self,size):
+        self.jobs = Queue.Queue()
+        self.done = collections.deque()
+        # number of futures put() but not yet reap()ed; only touched
+        # by the kernel's thread
+        self.pending = 0
+        (self.rfd, self.wfd) = os.pipe()
+        for fd in (self.rfd, self.wfd):
+            flags = fcntl.fcntl(fd,fcntl.F_GETFL)
+            fcntl.fcntl(fd,fcntl.F_SETFL,flags | os.O_NONBLOCK)
+        for i in range(size):
+            t = threading.Thread(target=self.worker)
+            t.setDaemon(True)
+            t.start()
+
+    def put(self,future):
+        self.pending += 1
+        self.jobs.put(future)
+
+    def reap(self):
+        """return the futures which have finished since last time"""
+        while True:
+            try:
+                if not os.read(self.rfd,4096):
+                    break
+            except OSError:
+                # EAGAIN -- empty
+                break
+        finished = []
+        while self.done:
+            finished.append(self.done.popleft())
+        self.pending -= len(finished)
+        return finished
+
+    def worker(self):
+        while True:
+            future = self.jobs.get()
+            future.run()
+            self.done.append(future)
+            try:
+                os.write(self.wfd,'.')
+            except OSError:
+                # pipe full -- kernel will be awake anyway
+                pass
+
+def mkpoller(method=None):
+    """Return a poller object for Kernel._poll() -- epoll if the
+    platform has it, else poll, else select, unless method names one.
+    Each has the same poll(rfds,wfds,files,timeout) method, which
+    returns (readable,writeable) lists of fds; files maps each fd to
+    the file it came from.  An fd which is in error or has hung up
+    is returned as both readable and writeable, so whoever is waiting
+    on it finds out.
+
+    >>> (r,w) = os.pipe()
+    >>> methods = ['select']
+    >>> if hasattr(select,'poll'): methods.append('poll')
+    >>> if hasattr(select,'epoll'): methods.append('epoll')
+    >>> for method in methods:
+    ...     p = mkpoller(method)
+    ...     assert p.poll([r],[w],{r: r, w: w},0) == ([],[w]), method
+    ...     n = os.write(w,'x')
+    ...     assert p.poll([r],[],{r: r},0) == ([r],[]), method
+    ...     assert os.read(r,1) == 'x'
+    ...     assert p.poll([r],[],{r: r},.01) == ([],[]), method
+    >>> os.close(r)
+    >>> os.close(w)
+
+    """
+    if method is None:
+        if hasattr(select,'epoll'):
+            method = 'epoll'
+        elif hasattr(select,'poll'):
+            method = 'poll'
+        else:
+            method = 'select'
+    if method == 'epoll':
+        return EpollPoller()
+    if method == 'poll':
+        return PollPoller()
+    if method == 'select':
+        return SelectPoller()
+    raise Exception("unknown poll method: %s" % method)
+
+class SelectPoller:
+    """select() -- portable, but limited to FD_SETSIZE descriptors,
+    and rescans every one of them on every call"""
+
+    method = 'select'
+
+    def poll(self,rfds,wfds,files,timeout):
+        (readable, writeable, inerror) = select.select(rfds,wfds,[],timeout)
+        return readable, writeable
+
+def _masks(rfds,wfds,rmask,wmask):
+    masks = {}
+    for fd in rfds:
+        masks[fd] = rmask
+    for fd in wfds:
+        masks[fd] = masks.get(fd,0) | wmask
+    return masks
+
+def _events(events,rmask,wmask):
+    readable = []
+    writeable = []
+    for (fd,event) in events:
+        if event & rmask:
+            readable.append(fd)
+        if event & wmask:
+            writeable.append(fd)
+    return readable, writeable
+
+class PollPoller:
+    """poll() -- no descriptor limit, but still rescans them all"""
+
+    method = 'poll'
+
+    def poll(self,rfds,wfds,files,timeout):
+        # registering is cheap; it's only a dict until poll() is called
+        p = select.poll()
+        rmask = select.POLLIN|select.POLLPRI
+        wmask = select.POLLOUT
+        for (fd,mask) in _masks(rfds,wfds,rmask,wmask).items():
+            p.register(fd,mask)
+        if timeout is not None:
+            timeout = int(math.ceil(timeout * 1000))
+        bad = select.POLLERR|select.POLLHUP|select.POLLNVAL
+        return _events(p.poll(timeout),rmask|bad,wmask|bad)
+
+class EpollPoller:
+    """epoll -- fds stay registered between calls, so each call only
+    costs in proportion to what changed and what's ready"""
+
+    method = 'epoll'
+
+    def __init__(self):
+        self.ep = select.epoll()
+        # what's registered: fd -> (mask, file); we hang onto the file
+        # so a closed and reused fd is noticed and registered again
+        self.registered = {}
+
+    def poll(self,rfds,wfds,files,timeout):
+        ep = self.ep
+        registered = self.registered
+        rmask = select.EPOLLIN|select.EPOLLPRI
+        wmask = select.EPOLLOUT
+        masks = _masks(rfds,wfds,rmask,wmask)
+        for fd in registered.keys():
+            if not masks.has_key(fd):
+                del registered[fd]
+                try:
+                    ep.unregister(fd)
+                except EnvironmentError:
+                    # already closed
+                    pass
+        # fds epoll won't take (regular files, bad fds) are always
+        # ready, same as select() would tell us or let us find out
+        always = []
+        for (fd,mask) in masks.items():
+            f = files.get(fd)
+            old = registered.get(fd)
+            if old is not None:
+                if old[0] == mask and old[1] is f:
+                    continue
+                try:
+                    ep.unregister(fd)
+                except EnvironmentError:
+                    pass
+            try:
+                ep.register(fd,mask)
+            except EnvironmentError, e:
+                if e.args and e.args[0] in (errno.EPERM, errno.EBADF):
+                    always.append((fd,mask))
+                    if registered.has_key(fd):
+                        del registered[fd]
+                    continue
+                raise
+            registered[fd] = (mask,f)
+        if always:
+            timeout = 0
+        if timeout is None:
+            timeout = -1
+        events = ep.poll(timeout) + always
+        bad = select.EPOLLERR|select.EPOLLHUP
+        return _events(events,rmask|bad,wmask|bad)
+
+def _fmtwaits(waits):
+    waits = waits.items()
+    waits.sort()
+    return ' '.join([ "%s=%.3f" % (wchan,secs) for (wchan,secs) in waits ])
+
+def _lineno(code,lasti):
+    # source line of bytecode offset lasti; -1 means not started yet
+    lineno = code.co_firstlineno
+    for (offset,line) in dis.findlinestarts(code):
+        if offset > lasti:
+            break
+        lineno = line
+    return lineno
+
+def _fileno(f):
+    if isinstance(f,int):
+        return f
+    return f.fileno()
 
 class Task:
     """
@@ -503,29 +1468,71 @@ class Task:
     
     def __init__(self,genobj,tid=None,parent=None,name=None):
         self.obj = genobj
-        nice = 0
         self.ptid = None
         if parent:
-            nice = parent.nice
             self.ptid = parent.tid
-        self.delay = nice
         self.errpin = None
+        self.io = None
         self.name = name
-        self.nice = nice
-        self.priority = nice
+        # scheduling class -- see Kernel.run()
+        self.sched = kernel.defaultclass
         self.result = kernel.eagain
         self.resultReady = True
         self.sleep = 0
         self.sleepDone = 0
+        self.timer = None
+        # pending kernel.offload() result
+        self.future = None
         self.itermode = False
+        self.queued = False
         self.tid = tid
+        self.label()
         self.time = time.time()
         self.until = None
         self.untilArgs = None
+        # tids of tasks waiting for us to finish
+        self.waiters = []
+        # buses we're subscribed to
+        self.buses = []
+        # profiling -- see Kernel.report()
+        self.steps = 0
+        self.cputime = 0.0
+        self.maxstep = 0.0
+        # seconds spent blocked, by wait channel
+        self.waits = {}
+        # what we're blocked on right now, and since when
+        self.wchan = None
+        self.waitStart = 0
 
     def __repr__(self):
         return str(self.__dict__)
 
+    def block(self,wchan,now):
+        """start charging wait time to wchan"""
+        self.unblock(now)
+        self.wchan = wchan
+        self.waitStart = now
+
+    def unblock(self,now):
+        if self.wchan:
+            self.waits[self.wchan] = \
+                self.waits.get(self.wchan,0) + now - self.waitStart
+            self.wchan = None
+
+    def label(self):
+        """name, or failing that the generator's Class.method name"""
+        if self.name:
+            return self.name
+        try:
+            frame = self.obj.gi_frame
+            self.name = frame.f_code.co_name
+            obj = frame.f_locals.get('self',None)
+            if obj is not None:
+                self.name = "%s.%s" % (obj.__class__.__name__,self.name)
+        except AttributeError:
+            self.name = getattr(self.obj,'__name__',str(self.obj))
+        return self.name
+
     # syntactic sugar to let us iterate on the task object as
     # if it were the generator object, while still allowing the
     # kernel to do the iteration and capture the results
@@ -548,7 +1555,7 @@ class Task:
         result = self.result
         debug("task.resultReady",self.resultReady)
         self.resultReady = False
-        kernel.HZ *= 10
+        kernel.wake(self.tid)
         return result
 
     def isdone(self):
@@ -33,6 +33,7 @@ class Main:
             'up',
             'fork',    
             'migrate',    
+            'ps',
             'start',
             'stop',
             'restart',
@@ -75,13 +76,14 @@ class Main:
 
     def main(self):
         synopsis = """
-        isconf [-DhrqV] [-c config ] [-m message] {verb} [verb args ...]
+        isconf [-DhnrqV] [-c config ] [-m message] {verb} [verb args ...]
         \n"""
         opt = {
             'c': ('config', '/etc/is/main.cf', "top-level configuration file" ),
             'D': ('debug',   False, "show debugging output"),
             'h': ('help',    False, "this text" ),
             'm': ('message', None,  "changelog and branch lock message" ),
+            'n': ('dryrun',  False, "with up: list superseded snaps, change nothing" ),
             'r': ('reboot_ok',False,"reboot during update if needed" ),
             'q': ('quiet',   False, "don't show verbose output"),
             'V': ('version', False, "show version"),
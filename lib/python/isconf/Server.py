@@ -29,6 +29,7 @@ class Server:
         self.confdir = "%s/conf" % self.ishome
         self.ctlpath = "%s/conf/.ctl" % self.ishome
         self.pidpath = "%s/conf/.pid" % self.ishome
+        self.pspath = "%s/conf/.ps" % self.ishome
 
     def start(self):
         """be a server forever"""
@@ -82,6 +83,10 @@ class Server:
 
     def init(self):
         """parent of all server tasks"""
+        kernel.slowstep = float(
+                os.environ.get('IS_SLOWSTEP',kernel.slowstep))
+        kernel.pollmethod = os.environ.get('IS_POLLER',None)
+
         # set up FBP netlist 
         BUS.log = Bus()
         unixsocks = Bus()
@@ -91,7 +96,7 @@ class Server:
         kernel.spawn(self.logger(bus=BUS.log))
 
         unix = Socket.UNIXServerFactory(path=self.ctlpath)
-        kernel.spawn(unix.run(out=unixsocks))
+        kernel.spawn(unix.run(out=unixsocks),sched='interactive')
 
         # tcp = Socket.TCPServerFactory(port=self.port)
         # kernel.spawn(tcp.run(out=tcpsocks))
@@ -101,7 +106,7 @@ class Server:
         kernel.spawn(cache.run())
 
         cli = ISconf.CLIServerFactory(socks=unixsocks)
-        kernel.spawn(cli.run())
+        kernel.spawn(cli.run(),sched='interactive')
 
         # XXX Cache and CLIServerFactory need dirs passed to them as
         # well, rather than them digging it out of env and redundantly
@@ -122,12 +127,17 @@ class Server:
         while True:
             yield None
             # periodic housekeeping
-            debug("mark: HZ =", kernel.HZ)
-            # import pprint
-            # pprint.pprint(kernel.ps())
+            debug("mark: tasks =", len(kernel.ps()))
+            self.psdump()
             yield kernel.sigsleep, 10
             # XXX check all buffers for unbounded growth
 
+    def psdump(self):
+        """write kernel profiling report where 'cat' can find it"""
+        tmp = self.pspath + ".tmp"
+        open(tmp,'w').write(kernel.report())
+        os.rename(tmp,self.pspath)
+
     def gpgsetup(self):
         gnupghome = "%s/.gnupg" % self.ishome
         gpg = GPG(gnupghome=gnupghome)
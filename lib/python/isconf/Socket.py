@@ -1,5 +1,6 @@
 
 from __future__ import generators
+import collections
 import errno
 import os
 import select
@@ -15,12 +16,12 @@ class ServerFactory:
     def run(self,out):
         """FBP component; emits ServerSocket refs on the 'out' pin""" 
         while True:
-            yield None
+            yield kernel.sigio, [self.sock], []
             try:
                 # accept new connections
                 (peersock, address) = self.sock.accept()
                 sock = ServerSocket(sock=peersock,address=address)
-                yield kernel.sigspawn, sock.run()
+                sock.tid = kernel.spawn(sock.run()).tid
                 while not out.tx(sock): yield None
             except socket.error, (error, strerror):
                 if not error == errno.EAGAIN:
@@ -29,27 +30,42 @@ class ServerFactory:
 class ServerSocket:
     """a TCP or UNIX domain server socket"""
 
+    # little writes are glued together up to this size, so they go
+    # out in one send()
+    coalesce = 65536
+
     def __init__(self,sock,address,chunksize=4096):
         self.chunksize = chunksize
         self.sock = sock
         self.address = address
         self.state = 'up'
-        self.txd = ''
+        # fifo of strings and buffers to send, and how much of the
+        # first one has gone already -- big writes are queued as they
+        # are rather than copied onto the end of one string
+        self.txd = collections.deque()
+        self.txpos = 0
         self.rxd = ''
+        # read offset into rxd -- consumed data is trimmed off the
+        # front lazily, so reading a big buffer in little pieces
+        # doesn't copy the rest of it every time
+        self.rxpos = 0
         self.protocol = None
+        # task running self.run(), and tasks waiting on rxd
+        self.tid = None
+        self.rxwaiters = []
     
     def __iter__(self):
         # reads one line at a time
         while True:
             if self.state == 'down':
                 return
-            nl = self.rxd.find("\n")
+            nl = self.rxd.find("\n",self.rxpos)
             if nl < 0:
                 # raises StopIteration if more data needed
                 return
             nl += 1
-            rxd = self.rxd[:nl]
-            self.rxd = self.rxd[nl:]
+            rxd = self.rxd[self.rxpos:nl]
+            self.consume(nl)
             yield rxd
 
     def abort(self,msg=''):
@@ -61,35 +77,69 @@ class ServerSocket:
 
     def close(self):
         self.state = 'closing'
+        self.wake()
+
+    def rxwait(self):
+        """Returns a signal to yield if you want to wait until there
+        is something to read(), or None if there's no need to wait."""
+        if self.state == 'down' or len(self.rxd) > self.rxpos:
+            return None
+        return kernel.sigpark, self.rxwaiters
 
     def read(self,size):
         # XXX also see MSG_PEEK flag in recv(2)
-        actual = min(size,len(self.rxd))
-        if actual == 0:
+        pos = self.rxpos
+        actual = min(size,len(self.rxd) - pos)
+        if actual <= 0:
             return ''
         # print repr(actual)
-        rxd = self.rxd[:actual]
+        rxd = self.rxd[pos:pos+actual]
         # print "reading", rxd
-        self.rxd = self.rxd[actual:]
+        self.consume(pos+actual)
         return rxd
+
+    def consume(self,pos):
+        # move read offset to pos, trimming rxd once more than half
+        # of it has been read
+        self.rxpos = pos
+        if pos * 2 >= len(self.rxd):
+            self.rxd = self.rxd[pos:]
+            self.rxpos = 0
     
     def write(self,data):
+        """queue data to send -- a string, or a memoryview or
+        buffer(), which is not copied"""
         # print "writing", repr(data)
-        self.txd += data
+        txd = self.txd
+        if txd and isinstance(data,str) and isinstance(txd[-1],str) \
+                and len(txd[-1]) + len(data) <= self.coalesce:
+            txd[-1] += data
+        elif len(data):
+            txd.append(data)
+        self.wake()
+
+    def wake(self):
+        # get run() out of select() so it notices new txd or state
+        if self.tid is not None:
+            kernel.wake(self.tid)
     
     def shutdown(self):
         self.sock.shutdown(1)
 
     def run(self):
-        busy = False
         while True:
             if self.state == 'down':
+                kernel.wakeall(self.rxwaiters)
                 break
-            if busy:
+            if self.txrx():
                 yield kernel.sigbusy
-            else:
-                yield kernel.signice,10
-            busy = self.txrx()
+                continue
+            # nothing doing -- wait for the peer, or for write() or
+            # close() to wake us
+            wlist = []
+            if self.txd or self.state != 'up':
+                wlist = [self.sock]
+            yield kernel.sigio, [self.sock], wlist
 
     def txrx(self):
         busy = False
@@ -98,7 +148,7 @@ class ServerSocket:
         s = self.sock
         try:
             (readable, writeable, inerror) = \
-                select.select([s],[s],[s],0.01)
+                select.select([s],[s],[s],0)
         except Exception, e:
             debug("socket exception", e)
             inerror = [s]
@@ -122,7 +172,7 @@ class ServerSocket:
                 pass
             # print "receiving", rxd
             self.rxd += rxd
-            if self.rxd:
+            if len(self.rxd) > self.rxpos:
                 busy = True
             else:
                 try:
@@ -130,6 +180,7 @@ class ServerSocket:
                 except:
                     pass
                 self.state = 'closing'
+            kernel.wakeall(self.rxwaiters)
 
         # do writes
         if s in writeable:
@@ -137,9 +188,15 @@ class ServerSocket:
                 if self.state == 'closing':
                     self.state = 'close'
                 return
-            # print "sending", self.txd
+            txd = self.txd[0]
+            if self.txpos:
+                if isinstance(txd,memoryview):
+                    txd = txd[self.txpos:]
+                else:
+                    txd = buffer(txd,self.txpos)
+            # print "sending", txd
             try:
-                sent = self.sock.send(self.txd)
+                sent = self.sock.send(txd)
                 # print "sent " + self.txd
             except:
                 try:
@@ -151,7 +208,10 @@ class ServerSocket:
             if sent:
                 busy = True
                 # txd is a fifo -- clear as we send bytes off the front
-                self.txd = self.txd[sent:]
+                self.txpos += sent
+                if self.txpos >= len(self.txd[0]):
+                    self.txd.popleft()
+                    self.txpos = 0
                 
 class TCPServerFactory(ServerFactory):
 
@@ -1,17 +1,59 @@
 
 from __future__ import generators
 from cStringIO import StringIO
-import email.Message
-import email.Parser
+import email.Header
 import email.Utils
+import hashlib
 import hmac
 import inspect
+import mmap
+import os
 import re
-import sha
+import stat
+import struct
 import sys
 import time
 import types
 
+# Payloads at least this big are handed out as a memoryview of the
+# buffer they arrived in, or a buffer() into an mmap of the file they
+# were read from, rather than copied -- see Message.rawpayload()
+_bigpayload = 65536
+
+# HMAC digests, by the name they go by in From lines.  sha1 is what
+# every isconf understands, so it's the default; blake2b is there if
+# hashlib has it (python 2.7 doesn't) or pyblake2 is installed.
+digests = {'sha1': hashlib.sha1, 'sha256': hashlib.sha256}
+try:
+    digests['blake2b'] = hashlib.blake2b
+except AttributeError:
+    try:
+        import pyblake2
+        digests['blake2b'] = pyblake2.blake2b
+    except ImportError:
+        pass
+
+# HMAC=hex means sha1 -- that's all older versions know how to read
+_hmacre = re.compile(r"HMAC(?:-([a-z0-9]+))?=([a-f0-9]+)")
+
+# Binary framing.  Text is what goes in journals and what every peer
+# understands; a peer which says it can take binary frames gets
+# these instead, which cost next to nothing to decode.  A frame is a
+# fixed header:
+#
+#   magic       2 bytes, '\xfb\x82' -- can't start a text message
+#   type        1 byte, _fmessage
+#   (unused)    1 byte
+#   fromlen     2 bytes, length of the From line, 0 if none
+#   headlen     4 bytes, length of the header block
+#   size        4 bytes, length of the payload
+#
+# all in network byte order, then the From line, the header block --
+# names and values, all separated by NULs -- and the payload.
+_magic = '\xfb\x82'
+_fmessage = 1
+_frame = struct.Struct('!2sBxHII')
+
 class fbp822:
     """Flow-based messages via simple RFC-822-like format.  
 
@@ -56,15 +98,16 @@ class fbp822:
     """
 
 
-    def __init__(self,authkey=None):
-        self.parser = email.Parser.Parser(Message)
+    def __init__(self,authkey=None,digest='sha1'):
         self.authkey = authkey
+        self.digest = digest
 
     def mkmsg(self,type,_payload='',**kwargs):
         msg = Message()
         msg.add_header('_type',type)
         if _payload is not None:
-            _payload=str(_payload)
+            if not isinstance(_payload,(memoryview,buffer)):
+                _payload=str(_payload)
             msg.set_payload(_payload)
             msg.add_header('_size',str(len(_payload)))
         else:
@@ -74,7 +117,7 @@ class fbp822:
                 raise Error822("parameter names can't start with '_'")
             msg.setheader(var,val)
         if self.authkey:
-            msg.hmacset(self.authkey)
+            msg.hmacset(self.authkey,self.digest)
         return msg
 
     msg = mkmsg
@@ -134,172 +177,721 @@ class fbp822:
         """
 
         txt = str(txt) # in case we were passed e.g. a StringIO() instance
-        msg = self.parser.parsestr(txt)
-        if not msg and txt.find('\n\n') > 0:
-            raise Error822("malformed headers")
-        try:
-            if not msg:
-                raise Error822("unable to parse")
-            if not msg.has_key('_type'):
-                raise Error822("missing _type header")
-            type = msg['_type']
-            if not type:
-                raise Error822("empty _type header")
-            if not msg.has_key('_size'):
-                raise Error822("missing _size header")
-            try:
-                size = int(msg['_size'])
-            except:
-                raise Error822("invalid _size value")
-            if size < 0: 
-                raise Error822("invalid _size value")
-        except Error822, e:
+        if txt[:1] == _magic[0]:
+            return self._parseframe(txt,trial,maxheaderlen)
+        blank = txt.find('\n\n')
+        if blank < 0:
             if trial:
                 if len(txt) > maxheaderlen:
                     raise Error822("headers too long: maxheaderlen exceeded")
                 raise Incomplete822(1)
-            raise Error822(e)
-        payload = msg.get_payload()
+            # no blank line -- it's all headers
+            (msg,size) = _parsehead(txt,blank)
+            payload = ''
+        else:
+            (msg,size) = _parsehead(txt[:blank+1],blank)
+            if len(txt) - blank - 2 >= _bigpayload:
+                payload = memoryview(txt)[blank+2:]
+            else:
+                payload = txt[blank+2:]
         actsize = len(payload)
-        if trial:
-            if txt.find('\n\n') <= 0:
-                raise Incomplete822(1)
-            if actsize < size:
-                raise Incomplete822(size - actsize)
+        if trial and actsize < size:
+            raise Incomplete822(size - actsize)
+        if actsize != size:
+            raise Error822(
+                "payload size mismatch: stated %d, actual %s" %
+                (size,actsize)
+                )
+        msg.set_payload(payload)
+        return msg
+
+    def _parseframe(self,txt,trial,maxheaderlen):
+        """parse() for a binary frame
+
+        >>> factory = fbp822()
+        >>> frame = factory.mkmsg('apple','abc',color='red').as_binary()
+        >>> factory.parse(frame).items()
+        [('_type', 'apple'), ('_size', '3'), ('color', 'red')]
+        >>> factory.parse(frame[:20],trial=True)
+        Traceback (most recent call last):
+            (...doctest ignores traceback detail...)
+        Incomplete822: 23
+        >>> factory.parse(frame[:-1],trial=True)
+        Traceback (most recent call last):
+            (...doctest ignores traceback detail...)
+        Incomplete822: 1
+        >>> factory.parse(frame + 'x')
+        Traceback (most recent call last):
+            (...doctest ignores traceback detail...)
+        Error822: payload size mismatch: stated 3, actual 4
+
+        """
+        try:
+            (msg,size,start) = _parseframe(txt,0,maxheaderlen)
+        except Incomplete822:
+            if trial:
+                raise
+            raise Error822("truncated frame")
+        actsize = len(txt) - start
+        if trial and actsize < size:
+            raise Incomplete822(size - actsize)
         if actsize != size:
-            # print repr(payload)
             raise Error822(
                 "payload size mismatch: stated %d, actual %s" %
                 (size,actsize)
                 )
+        if size >= _bigpayload:
+            msg.set_payload(memoryview(txt)[start:])
+        else:
+            msg.set_payload(txt[start:])
         return msg
 
-    def fromStream(self,stream,outpin=None,intask=True):
+    def fromStream(self,stream,outpin=None,intask=True,chunksize=4096):
         """generate message objects from a file or isconf.Socket
         
         If outpin is set, then use FBP Bus API, otherwise act as ordinary
         generator, yielding messages.
         
         """
-        rxd = ''
-        wanted = 1
-        # read one message each time through complete loop
-        factory = fbp822()
-        i = 0
+        parser = Parser822()
         while True:
             if intask:
                 yield None
             if hasattr(stream,'state') and stream.state == 'down':
-                if outpin: outpin.close()
                 break
-            newrxd = stream.read(wanted)
-            # if isinstance(stream,file) and not len(newrxd):
+            # the parser keeps anything past the end of a message for
+            # the next one, so we can read as much as we like
+            newrxd = stream.read(max(parser.wanted(),chunksize))
             if not len(newrxd):
                 # at EOF
-                if outpin: 
-                    outpin.close()
                 break
-            rxd += newrxd
-            # discard leading newlines
-            if rxd == '\n':
-                rxd = ''
-                continue
-            # try to parse a message
-            try:
-                msg = factory.parse(rxd,trial=True)
-            except Incomplete822, e:
-                # nope, didn't get it all
-                wanted = int(str(e))
-                continue
-            # yay. got it all
-            if outpin is not None:
-                while not outpin.tx(msg): yield None
-            else:
-                yield msg
-            rxd = ''
-            wanted = 1
-        if rxd:
-            # hmm.  junk at end of stream.  XXX discard for now
-            pass
-
-    def fromFile(self,stream,outpin=None,intask=True):
+            for msg in parser.feed(newrxd):
+                if outpin is not None:
+                    while not outpin.tx(msg): yield None
+                else:
+                    yield msg
+        if outpin: 
+            outpin.close()
+        if parser.error:
+            raise parser.error
+        # XXX junk at end of stream (parser.pending()) discarded for now
+
+    def fromFile(self,stream,outpin=None,intask=True,chunksize=65536,
+            batch=False,parser=None):
         """generate message objects from a file-like object
 
-        higher performance than fromStream
-        
         If outpin is set, then use FBP Bus API, otherwise act as ordinary
-        generator, yielding messages.
+        generator, yielding messages.  If batch is True, the messages
+        from each chunk read come out together, as a list -- which
+        saves a trip through the generator, or the Bus, for each one
+        when replaying a whole journal.  Pass in a Parser822 as parser
+        to find out afterward where in the stream the last whole
+        message ended:  that's parser.done.
+
+        If stream is a regular file, it is also mmap'd, and big
+        payloads are left in the file rather than read in:  they come
+        out as buffer() objects pointing into the map.  The map stays
+        valid as long as the file is only ever appended to or replaced
+        -- never truncated in place -- which is how journals are
+        written.
+
+        >>> factory = fbp822()
+        >>> txt = str(factory.mkmsg('a','1')) + "\\n" + str(factory.mkmsg('b'))
+        >>> for msg in factory.fromFile(StringIO(txt),intask=False,chunksize=7):
+        ...     print msg.type(), repr(msg.data())
+        a '1'
+        b ''
+        >>> import tempfile
+        >>> fh = tempfile.TemporaryFile()
+        >>> big = factory.mkmsg('c','x' * _bigpayload)
+        >>> fh.write(str(factory.mkmsg('a','1')) + str(big) + txt)
+        >>> _ = fh.seek(0)
+        >>> mlist = list(factory.fromFile(fh,intask=False,chunksize=100))
+        >>> [ msg.type() for msg in mlist ]
+        ['a', 'c', 'a', 'b']
+        >>> type(mlist[1].rawpayload()).__name__
+        'buffer'
+        >>> assert mlist[1].data() == big.data()
+        >>> assert str(mlist[1]) == str(big)
+        >>> _ = fh.seek(0)
+        >>> for mlist in factory.fromFile(fh,intask=False,chunksize=1000,
+        ...         batch=True):
+        ...     print [ msg.type() for msg in mlist ]
+        ['a', 'c']
+        ['a', 'b']
         
         """
-        rxd = ''
-        total = 0
-        # read one message each time through complete loop
-        factory = fbp822()
-        i = 0
-        (START,HEAD,PARSE,BODY,SEND) = range(5)
-        state=START
-        for line in stream:
+        if parser is None:
+            parser = Parser822()
+        parser.backing = _mapfile(stream)
+        parser.offset = parser.done = _tell(stream)
+        while True:
             if intask:
                 yield None
-            if state is START:
-                # discard leading newlines
-                if line == '\n':
-                    continue
-                if line.startswith("From "):
-                    state = HEAD
-            rxd += line
-            if state is HEAD:
-                if line == '\n':
-                    state = PARSE
-                else:
-                    continue
-            if state is BODY:
-                if len(rxd) < total:
-                    continue
-                if len(rxd) > total:
-                    print rxd, total
-                    break
-                state = PARSE
-            if state is PARSE:
-                # try to parse a message
-                try:
-                    msg = factory.parse(rxd,trial=True)
-                    state = SEND
-                except Incomplete822, e:
-                    # nope, didn't get it all
-                    print e
-                    total = int(str(e)) + len(rxd)
-                    state = BODY
+            rxd = stream.read(chunksize)
+            if not rxd:
+                break
+            try:
+                mlist = parser.feed(rxd)
+            except Error822, e:
+                print >>sys.stderr, e
+                break
+            skip = parser.skipahead()
+            if skip:
+                # rest of a payload the parser took from the map
+                stream.seek(skip,1)
+            if batch:
+                if not mlist:
                     continue
-                except Exception, e:
-                    print e
-                    break
-            if state is SEND:
-                # yay. got it all
+                mlist = [mlist]
+            for msg in mlist:
                 if outpin is not None:
                     while not outpin.tx(msg): yield None
                 else:
                     yield msg
-                rxd = ''
-                total = 0
-                state = START
-                continue
-            print >>sys.stderr, "unidentified line:", line
-
-        if rxd:
-            print >>sys.stderr, "junk found at end of stream:", rxd
+        if parser.error:
+            print >>sys.stderr, parser.error
+        elif parser.pending():
+            print >>sys.stderr, "junk found at end of stream"
         if outpin: 
             outpin.close()
 
+def _mapfile(stream):
+    """return a read-only mmap of stream, or None if it isn't a
+    non-empty regular file"""
+    try:
+        fd = stream.fileno()
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode) or not st.st_size:
+            return None
+        return mmap.mmap(fd,0,access=mmap.ACCESS_READ)
+    except (AttributeError,EnvironmentError,ValueError):
+        return None
+
+def _tell(stream):
+    try:
+        return stream.tell()
+    except (AttributeError,EnvironmentError):
+        return 0
+
+class Parser822:
+    """Incremental fbp822 parser.  Feed it data in pieces of any size
+    as it arrives, and it hands back each message as soon as the last
+    byte of it is in.  Nothing is parsed twice:  the parser only scans
+    for the blank line at the end of the headers, and once those are
+    parsed it knows from _size exactly how many payload bytes to
+    collect.  Data past the end of one message is kept for the next;
+    newlines between messages are skipped.
+
+    >>> factory = fbp822()
+    >>> txt = str(factory.mkmsg('apple','abc\\n',color='red'))
+    >>> txt += str(factory.mkmsg('pear','xyz'))
+    >>> parser = Parser822()
+    >>> got = []
+    >>> for c in txt:
+    ...     got += parser.feed(c)
+    ...     if len(got) == 0 and parser.wanted() > 1:
+    ...         print parser.wanted(),
+    4 3 2
+    >>> [ (msg.type(), msg['color'], msg.data()) for msg in got ]
+    [('apple', 'red', 'abc\\n'), ('pear', None, 'xyz')]
+    >>> parser.pending()
+    False
+    >>> parser.done == len(txt)
+    True
+    >>> data = "\\n\\n" + txt
+    >>> parser = Parser822(spans=[])
+    >>> mlist = parser.feed(data)
+    >>> [ data[start:end] == str(msg)
+    ...     for ((start,end),msg) in zip(parser.spans,mlist) ]
+    [True, True]
+    >>> parser.feed('From x\\nno colon here\\n\\n')
+    Traceback (most recent call last):
+        (...doctest ignores traceback detail...)
+    Error822: malformed headers
+
+    Messages ahead of bad data still come out; the error is raised
+    by the next feed().
+
+    >>> parser = Parser822()
+    >>> [ msg.type() for msg in parser.feed(txt + 'no colon here\\n\\n') ]
+    ['apple', 'pear']
+    >>> parser.pending()
+    True
+    >>> parser.feed('')
+    Traceback (most recent call last):
+        (...doctest ignores traceback detail...)
+    Error822: malformed headers
+
+    A big payload which arrives all in one piece isn't copied out of
+    it; the message gets a memoryview of the data that was fed.
+
+    >>> txt = str(factory.mkmsg('big','x' * _bigpayload))
+    >>> msg = Parser822().feed(txt + txt[:10])[0]
+    >>> type(msg.rawpayload()).__name__
+    'memoryview'
+    >>> assert str(msg) == txt
+
+    Binary frames -- see Message.frame() -- can be mixed in with text.
+
+    >>> txt = factory.mkmsg('a','1').as_binary() + str(factory.mkmsg('b'))
+    >>> [ msg.type() for msg in Parser822().feed(txt) ]
+    ['a', 'b']
+
+    backing is an mmap of the stream being fed, if there is one, and
+    offset is where in it the first byte fed comes from.  Big payloads
+    are then taken straight from the map, and the rest of the payload
+    need not be fed at all -- see skipahead().
+
+    """
+
+    def __init__(self,maxheaderlen=65536,bigpayload=_bigpayload,
+            backing=None,offset=0,spans=None):
+        self.maxheaderlen = maxheaderlen
+        self.bigpayload = bigpayload
+        self.backing = backing
+        # position in backing of the next byte to be fed, and just
+        # past the end of the last message we handed back
+        self.offset = offset
+        self.done = offset
+        # if spans is a list, (start, end) of each message handed back
+        # is appended to it; mstart is where the current one started
+        self.spans = spans
+        self.mstart = offset
+        # payload bytes still to come which we'll throw away, because
+        # the payload was taken from backing
+        self.skip = 0
+        # header text seen so far, and where to resume looking for
+        # the blank line
+        self.head = ''
+        self.scan = 0
+        # message whose payload we're collecting
+        self.msg = None
+        self.size = 0
+        self.body = []
+        self.have = 0
+        # error found after messages we've still to hand back
+        self.error = None
+
+    def feed(self,data):
+        """add data, return list of messages it completed
+
+        If the data goes bad after one or more good messages, those
+        messages are returned, and the error is raised by the next
+        call instead -- so what comes out before an error doesn't
+        depend on how the data was split up.
+
+        """
+        if self.error:
+            raise self.error
+        out = []
+        try:
+            self._feed(data,out)
+        except Error822, e:
+            if not out:
+                raise
+            self.error = e
+        return out
+
+    def _feed(self,data,out):
+        # work through data by index rather than slicing off what
+        # we've used, so the data is only copied where it has to be
+        pos = 0
+        end = len(data)
+        base = self.offset
+        self.offset += end
+        if self.skip:
+            pos = min(self.skip,end)
+            self.skip -= pos
+        while pos < end:
+            if self.msg is None:
+                if self.head:
+                    data = self.head + data[pos:]
+                    base += pos - len(self.head)
+                    pos = 0
+                    end = len(data)
+                    self.head = ''
+                else:
+                    # skip newlines between messages
+                    while pos < end and data[pos] == '\n':
+                        pos += 1
+                    if pos == end:
+                        break
+                self.mstart = base + pos
+                if data[pos] == _magic[0]:
+                    # binary frame
+                    try:
+                        (msg,size,start) = _parseframe(
+                            data,pos,self.maxheaderlen)
+                    except Incomplete822:
+                        self.head = data[pos:]
+                        break
+                else:
+                    scan = pos
+                    if self.scan:
+                        scan += self.scan - 1
+                    blank = data.find('\n\n',scan)
+                    if blank < 0:
+                        self.scan = 0
+                        if end - pos > self.maxheaderlen:
+                            raise Error822("headers too long: maxheaderlen exceeded")
+                        self.head = data[pos:]
+                        self.scan = len(self.head)
+                        break
+                    self.scan = 0
+                    (msg,size) = _parsehead(data[pos:blank+1],blank-pos)
+                    start = blank + 2
+                if size < self.bigpayload and start + size <= end:
+                    # the usual case:  a small payload, all here
+                    pos = start + size
+                    msg.set_payload(data[start:pos])
+                    out.append(msg)
+                    self.done = base + pos
+                    if self.spans is not None:
+                        self.spans.append((self.mstart,self.done))
+                    continue
+                (self.msg,self.size) = (msg,size)
+                pos = start
+                self.body = []
+                self.have = 0
+            need = self.size - self.have
+            avail = end - pos
+            if not self.have and need >= self.bigpayload:
+                start = base + pos
+                if self.backing is not None \
+                        and start + need <= len(self.backing):
+                    self.msg.set_payload(buffer(self.backing,start,need))
+                    self.skip = max(0,need - avail)
+                    pos = min(end,pos + need)
+                    self.done = start + need
+                    need = 0
+                elif avail >= need:
+                    self.msg.set_payload(memoryview(data)[pos:pos+need])
+                    pos += need
+                    self.done = base + pos
+                    need = 0
+                if not need:
+                    out.append(self.msg)
+                    if self.spans is not None:
+                        self.spans.append((self.mstart,self.done))
+                    self.msg = None
+                    continue
+            if need:
+                take = min(need,avail)
+                if take == end:
+                    chunk = data
+                else:
+                    chunk = data[pos:pos+take]
+                self.body.append(chunk)
+                self.have += take
+                pos += take
+            if self.have == self.size:
+                msg = self.msg
+                msg.set_payload(''.join(self.body))
+                out.append(msg)
+                self.done = base + pos
+                if self.spans is not None:
+                    self.spans.append((self.mstart,self.done))
+                self.msg = None
+                self.body = []
+
+    def skipahead(self):
+        """Return how many bytes of input we'd only throw away,
+        because they're the rest of a payload taken from backing, and
+        forget about them.  The caller must then skip over that many
+        bytes itself, rather than feed them."""
+        skip = self.skip
+        self.offset += skip
+        self.skip = 0
+        return skip
+
+    def wanted(self):
+        """how many more bytes we need, at least, to finish the
+        message we're working on"""
+        if self.msg is None:
+            return 1
+        return self.size - self.have
 
+    def pending(self):
+        """true if we're holding part of a message, or an error"""
+        return bool(self.head or self.msg is not None or self.error)
 
-class Message(email.Message.Message):
+def _parseframe(data,pos,maxheaderlen=65536):
+    """parse the binary frame header at data[pos:], return (message,
+    payload size, where the payload starts), or raise Incomplete822
+    if the headers aren't all there yet"""
+    end = pos + _frame.size
+    if len(data) < end:
+        raise Incomplete822(end - len(data))
+    (magic,type,fromlen,headlen,size) = _frame.unpack_from(data,pos)
+    if magic != _magic or type != _fmessage:
+        raise Error822("bad frame header")
+    if fromlen + headlen > maxheaderlen:
+        raise Error822("headers too long: maxheaderlen exceeded")
+    hstart = end + fromlen
+    end = hstart + headlen
+    if len(data) < end:
+        raise Incomplete822(end - len(data))
+    msg = Message()
+    if fromlen:
+        msg._unixfrom = data[hstart-fromlen:hstart]
+    head = data[hstart:end].split('\0')
+    if len(head) % 2:
+        raise Error822("malformed headers")
+    head[::2] = map(intern,head[::2])
+    msg._head = tuple(head)
+    if '_type' not in msg._head[::2]:
+        raise Error822("missing _type header")
+    return msg, size, end
+
+_headerre = re.compile(r'[\041-\071\073-\176]+:')
+
+# splits a block of plain "name: value" lines into ['', name, value,
+# '', name, value, ... ''] -- anything in the block which isn't such
+# a line turns up in place of one of the ''s
+_splitre = re.compile(r'([\041-\071\073-\176]+):[ \t]*([^\n]*)\n')
+
+def _parsehead(txt,blank):
+    """parse a header block, return (message, payload size)
+
+    Follows email.Parser's rules, so header values come out the same
+    as they always have:  leading whitespace is stripped, and folded
+    lines are kept with their newlines.  blank is where the blank line
+    was found, or -1 if there wasn't one.
+
+    Nearly every block is just a From line and plain headers, which
+    _splitre takes apart in one pass; the rest go line by line.
+
+    >>> msg = _parsehead('From x\\n_type: a\\n_size:  3\\ncolor:red \\n',-1)[0]
+    >>> msg.get_unixfrom(), msg.items()
+    ('From x', [('_type', 'a'), ('_size', '3'), ('color', 'red ')])
+    >>> msg = _parsehead('_type: a\\n_size: 0\\ntext: one\\n  two\\n',-1)[0]
+    >>> msg.items()
+    [('_type', 'a'), ('_size', '0'), ('text', 'one\\n  two')]
+
+    """
+    msg = Message()
+    head = None
+    if txt.endswith('\n') and '\r' not in txt \
+            and '\x0b' not in txt and '\x0c' not in txt:
+        start = 0
+        if txt.startswith('From '):
+            start = txt.find('\n') + 1
+        parts = _splitre.split(txt[start:])
+        if len(parts) > 1 and not ''.join(parts[::3]):
+            head = [None] * (len(parts) / 3 * 2)
+            head[::2] = map(intern,parts[1::3])
+            head[1::2] = parts[2::3]
+            if start:
+                msg._unixfrom = txt[:start-1]
+    if head is None:
+        head = _parselines(msg,txt,blank)
+    msg._head = tuple(head)
+    if head[0] == '_type' and len(head) > 3 and head[2] == '_size':
+        # where mkmsg() puts them
+        (type,size) = (head[1],head[3])
+    else:
+        type = msg['_type']
+        size = msg['_size']
+    if type is None:
+        raise Error822("missing _type header")
+    if not type:
+        raise Error822("empty _type header")
+    if size is None:
+        raise Error822("missing _size header")
+    try:
+        size = int(size)
+    except:
+        raise Error822("invalid _size value")
+    if size < 0: 
+        raise Error822("invalid _size value")
+    return msg, size
+
+def _parselines(msg,txt,blank):
+    """_parsehead() the long way, for blocks with folded lines, CRs,
+    or anything unexpected; returns the flattened headers"""
+    headers = []
+    lines = txt.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    for i in range(len(lines)):
+        line = lines[i]
+        if line[:1] in (' ','\t'):
+            if headers:
+                # continuation of previous header
+                (var,val) = headers[-1]
+                headers[-1] = (var, val + '\n' + line)
+            continue
+        if line.startswith('From '):
+            if i == 0:
+                msg.set_unixfrom(line)
+            continue
+        match = _headerre.match(line)
+        if not match:
+            if not headers:
+                if blank > 0:
+                    raise Error822("malformed headers")
+                raise Error822("unable to parse")
+            raise Error822("malformed headers")
+        end = match.end()
+        headers.append((line[:end-1], line[end:].lstrip()))
+    for j in range(len(headers)):
+        (var,val) = headers[j]
+        if val.endswith('\r'):
+            headers[j] = (var, val.rstrip('\r\n'))
+    if not headers:
+        raise Error822("unable to parse")
+    head = []
+    for (var,val) in headers:
+        head.append(intern(var))
+        head.append(val)
+    return head
+
+
+
+class Message(object):
+    """One fbp822 message:  an ordered list of headers, a payload, and
+    the From line which carries the HMAC.
+
+    This used to be an email.Message.Message; it still answers the
+    parts of that API we use -- msg['x'], get(), has_key(), items(),
+    add_header(), get_payload() and friends -- but a journal replay
+    keeps tens of thousands of these around, so it carries only what
+    it needs.  Headers are kept as one flat tuple of names and values,
+    header names are interned, and typed values are only decoded when
+    asked for via msg.head.
+
+    >>> msg = Message()
+    >>> msg.add_header('_type','apple')
+    >>> msg['_size'] = '0'
+    >>> msg['Color'] = 'red'
+    >>> msg['color'], msg.get('flavor','none'), msg.has_key('_type')
+    ('red', 'none', True)
+    >>> msg.items()
+    [('_type', 'apple'), ('_size', '0'), ('Color', 'red')]
+    >>> del msg['color']
+    >>> msg.keys(), len(msg)
+    (['_type', '_size'], 2)
+
+    """
+
+    __slots__ = ('_head', '_payload', '_unixfrom', '_htext', '_text')
 
     def __init__(self):
-        email.Message.Message.__init__(self)
-        date = time.ctime()
-        self.set_unixfrom('From fbp822 %s' % (date))
-        self.head = Head(self)
+        # (name, value, name, value, ...)
+        self._head = ()
+        self._payload = None
+        # From line; filled in with the current date when first needed
+        self._unixfrom = None
+        # rendered headers, and headers and payload -- see chunks()
+        # and as_string()
+        self._htext = None
+        self._text = None
+
+    # email.Message compatibility.  Header lookups are case-blind,
+    # same as email.Message, but we try an exact match first.
+
+    def _find(self,name):
+        head = self._head
+        for i in xrange(0,len(head),2):
+            if head[i] == name:
+                return i
+        name = name.lower()
+        for i in xrange(0,len(head),2):
+            if head[i].lower() == name:
+                return i
+        return -1
+
+    def get(self,name,failobj=None):
+        i = self._find(name)
+        if i < 0:
+            return failobj
+        return self._head[i+1]
+
+    def __getitem__(self,name):
+        return self.get(name)
+
+    def get_all(self,name,failobj=None):
+        name = name.lower()
+        head = self._head
+        vals = [ head[i+1] for i in xrange(0,len(head),2) 
+            if head[i].lower() == name ]
+        return vals or failobj
+
+    def has_key(self,name):
+        return self._find(name) >= 0
+
+    __contains__ = has_key
+
+    def add_header(self,name,val):
+        self._head += (intern(name), val)
+        self._htext = self._text = None
+
+    __setitem__ = add_header
+
+    def __delitem__(self,name):
+        name = name.lower()
+        head = self._head
+        keep = []
+        for i in xrange(0,len(head),2):
+            if head[i].lower() != name:
+                keep.extend(head[i:i+2])
+        self._head = tuple(keep)
+        self._htext = self._text = None
+
+    def replace_header(self,name,val):
+        i = self._find(name)
+        if i < 0:
+            raise KeyError(name)
+        head = self._head
+        self._head = head[:i+1] + (val,) + head[i+2:]
+        self._htext = self._text = None
+
+    def keys(self):
+        return list(self._head[::2])
+
+    def values(self):
+        return list(self._head[1::2])
+
+    def items(self):
+        return zip(self._head[::2],self._head[1::2])
+
+    def __len__(self):
+        return len(self._head) / 2
+
+    def __iter__(self):
+        return iter(self._head[::2])
+
+    def get_payload(self):
+        payload = self._payload
+        if payload is None or isinstance(payload,str):
+            return payload
+        return _bytes(payload)
+
+    def rawpayload(self):
+        """Return the payload without copying it.  This is a string,
+        or for a big payload, maybe a memoryview or buffer() -- see
+        Parser822 -- which can be handed as is to file.write(),
+        socket.send(), or a hash's update().  Use get_payload() if
+        you need a string."""
+        return self._payload
+
+    def set_payload(self,payload):
+        self._payload = payload
+        self._text = None
+
+    def get_unixfrom(self):
+        if self._unixfrom is None:
+            self._unixfrom = 'From fbp822 %s' % time.ctime()
+        return self._unixfrom
+
+    def set_unixfrom(self,unixfrom):
+        self._unixfrom = unixfrom
+
+    def head(self):
+        return Head(self)
+
+    head = property(head)
 
     def data(self):
         return self.get_payload()
@@ -331,52 +923,279 @@ class Message(email.Message.Message):
         elif isinstance(val,types.IntType):
             self.add_header("_type_%s" % var,"i")
 
-    def hmac_calculated(self,key):
-        h = hmac.new(key,msg=self.as_string(),digestmod=sha)
+    def _signed(self):
+        # what HMACs are calculated over:  as_string(), in pieces if
+        # the payload is too big for as_string() to keep
+        payload = self._payload
+        if payload is None or len(payload) < _bigpayload:
+            return (self.as_string(),)
+        return self.chunks()
+
+    def hmac_calculated(self,key,digest='sha1'):
+        """key is a key string, or an hmackey() of one"""
+        h = _hmacstart(key,digest)
+        for chunk in self._signed():
+            h.update(chunk)
         digest = h.hexdigest()
         return digest
 
-    def hmac_claimed(self):
-        fromline = self.get_unixfrom()
-        # print repr(self),fromline
-        match = re.search("HMAC=([a-f0-9]+)",fromline)
+    def _claim(self):
+        # (digest name, HMAC) from the From line, or None
+        match = _hmacre.search(self.get_unixfrom())
         if not match:
             return None
-        return match.group(1)
+        return (match.group(1) or 'sha1', match.group(2))
+
+    def hmac_claimed(self):
+        claim = self._claim()
+        if claim is None:
+            return None
+        return claim[1]
+
+    def hmac_digest(self):
+        """name of the digest the From line says the HMAC uses"""
+        claim = self._claim()
+        if claim is None:
+            return None
+        return claim[0]
 
     def hmacok(self,key):
-        claimed = self.hmac_claimed()
-        wanted = self.hmac_calculated(key)
-        return wanted == claimed
+        return self.hmacmatch([key]) is not None
+
+    def hmacmatch(self,keys):
+        """Return the first of keys the message's HMAC checks out
+        against, or None.  The message is only rendered once however
+        many keys there are, so this is the way to try several.  The
+        digest is whichever one the From line names.
+
+        >>> keys = [ hmackey(k) for k in ('old', 'new') ]
+        >>> msg = fbp822(authkey='new').mkmsg('apple')
+        >>> msg.hmacmatch(keys) is keys[1]
+        True
+        >>> msg.hmacmatch(keys[:1])
+        >>> msg.hmacmatch(['new'])
+        'new'
+        >>> msg.hmacset('old','sha256')
+        '24315540e8850dc1ed826dae71f191eb51cffc878fe448b88f7de97f8464f070'
+        >>> msg.hmac_digest()
+        'sha256'
+        >>> msg.hmacmatch(keys) is keys[0]
+        True
+        >>> msg.set_unixfrom(msg.get_unixfrom().replace('sha256','md5'))
+        >>> msg.hmacmatch(keys)
 
-    def hmacset(self,key):
-        digest = self.hmac_calculated(key)
+        """
+        claim = self._claim()
+        if claim is None:
+            return None
+        (digest,claimed) = claim
+        if not digests.has_key(digest):
+            return None
+        signed = self._signed()
+        for key in keys:
+            h = _hmacstart(key,digest)
+            for chunk in signed:
+                h.update(chunk)
+            if hmac.compare_digest(h.hexdigest(),claimed):
+                return key
+        return None
+
+    def hmacset(self,key,digest='sha1'):
+        hexdigest = self.hmac_calculated(key,digest)
         date = time.ctime()
-        self.set_unixfrom('From fbp822 %s HMAC=%s' % (date,digest))
-        return digest
+        if digest == 'sha1':
+            tag = 'HMAC'
+        else:
+            tag = 'HMAC-%s' % digest
+        self.set_unixfrom('From fbp822 %s %s=%s' % (date,tag,hexdigest))
+        return hexdigest
 
     def as_string(self, unixfrom=0):
         """Return the entire formatted message as a string.
         Optional `unixfrom' when true, means include the Unix From_ envelope
         header.
 
-        Overridden from email.Message in order to turn off
-        mangle_from_.
+        Headers and payload are written out in the same format
+        email.Generator (with mangle_from_ off) used to produce, and
+        unless the payload is big, the result is kept until a header
+        or the payload changes.
+
+        >>> msg = fbp822().mkmsg('apple','abc',color='red')
+        >>> msg.as_string()
+        '_type: apple\\n_size: 3\\ncolor: red\\n\\nabc'
+        >>> msg.as_string() is msg.as_string()
+        True
+        >>> msg.setheader('color','green')
+        >>> msg.as_string()
+        '_type: apple\\n_size: 3\\ncolor: green\\n\\nabc'
+        >>> msg.payload('xy')
+        'xy'
+        >>> msg.as_string()
+        '_type: apple\\ncolor: green\\n_size: 2\\n\\nxy'
+
+        """
+        text = self._text
+        if text is None:
+            (head,payload) = self.chunks()
+            text = head + _bytes(payload)
+            if len(payload) < _bigpayload:
+                # a copy of a big payload isn't worth keeping
+                self._text = text
+        if unixfrom:
+            return self.get_unixfrom() + '\n' + text
+        return text
+
+    def chunks(self,unixfrom=0):
+        """Return the message as a (headers, payload) pair which,
+        written out one after the other, give as_string(unixfrom).
+        The payload is rawpayload(), so it isn't copied.
+
+        >>> msg = fbp822().mkmsg('apple',memoryview('abc'))
+        >>> (head,payload) = msg.chunks()
+        >>> head
+        '_type: apple\\n_size: 3\\n\\n'
+        >>> payload.tobytes()
+        'abc'
+        >>> fh = StringIO()
+        >>> msg.writeto(fh)
+        >>> fh.getvalue() == msg.as_string()
+        True
+
         """
-        from email.Generator import Generator
-        fp = StringIO()
-        g = Generator(fp,mangle_from_=False)
-        g.flatten(self, unixfrom=unixfrom)
-        return fp.getvalue()
+        payload = self._payload
+        if payload is None:
+            payload = ''
+        elif not isinstance(payload,(basestring,memoryview,buffer)):
+            raise TypeError('string payload expected: %s' % type(payload))
+        text = self._htext
+        if text is None:
+            head = self._head
+            lines = [ _fmthead(head[i],head[i+1]) 
+                for i in xrange(0,len(head),2) ]
+            lines.append('')
+            lines.append('')
+            text = self._htext = '\n'.join(lines)
+        if unixfrom:
+            text = self.get_unixfrom() + '\n' + text
+        return (text, payload)
+
+    def frame(self,unixfrom=0):
+        """Like chunks(), but as a binary frame rather than text.
+
+        >>> msg = fbp822().mkmsg('apple','abc',color='red')
+        >>> (head,payload) = msg.frame()
+        >>> _frame.unpack(head[:_frame.size])
+        ('\\xfb\\x82', 1, 0, 29, 3)
+        >>> head[_frame.size:]
+        '_type\\x00apple\\x00_size\\x003\\x00color\\x00red'
+        >>> msg['bad'] = 'nul\\0'
+        >>> msg.frame()
+        Traceback (most recent call last):
+            (...doctest ignores traceback detail...)
+        Error822: NUL in header
+
+        """
+        head = self._head
+        block = '\0'.join(head)
+        if block.count('\0') != len(head) - 1:
+            raise Error822("NUL in header")
+        fromline = ''
+        if unixfrom:
+            fromline = self.get_unixfrom()
+        payload = self._payload
+        if payload is None:
+            payload = ''
+        hdr = _frame.pack(_magic,_fmessage,len(fromline),len(block),
+                len(payload))
+        return (hdr + fromline + block, payload)
+
+    def as_binary(self,unixfrom=0):
+        """the whole message as one binary frame"""
+        (head,payload) = self.frame(unixfrom)
+        return head + _bytes(payload)
+
+    def writeto(self,fh,unixfrom=0,binary=False):
+        """write the message to fh without building it as one string,
+        as a binary frame if binary is true"""
+        if binary:
+            chunks = self.frame(unixfrom)
+        elif self._payload is None or len(self._payload) < _bigpayload:
+            # small enough that as_string() keeps a copy
+            fh.write(self.as_string(unixfrom))
+            return
+        else:
+            chunks = self.chunks(unixfrom)
+        for chunk in chunks:
+            if len(chunk):
+                fh.write(chunk)
+
+    def __str__(self):
+        return self.as_string(unixfrom=True)
+
+def _digestmod(digest):
+    try:
+        return digests[digest]
+    except KeyError:
+        raise Error822("unsupported HMAC digest: %s" % digest)
+
+class hmackey(object):
+    """A key set up for computing HMACs.  hmac.new() hashes the key
+    into its inner and outer digests; hand one of these to
+    hmac_calculated(), hmacok() or hmacmatch() and each message starts
+    from a copy of those rather than redoing them.  The setup is done
+    once per digest, the first time each is asked for."""
+
+    __slots__ = ('key', '_states')
+
+    def __init__(self,key):
+        self.key = key
+        self._states = {}
+
+    def new(self,digest='sha1'):
+        """a fresh hmac object for digest, keyed with key"""
+        state = self._states.get(digest)
+        if state is None:
+            state = hmac.new(self.key,digestmod=_digestmod(digest))
+            self._states[digest] = state
+        return state.copy()
+
+def _hmacstart(key,digest):
+    if isinstance(key,basestring):
+        return hmac.new(key,digestmod=_digestmod(digest))
+    return key.new(digest)
+
+def _bytes(payload):
+    """payload as a string"""
+    if isinstance(payload,memoryview):
+        return payload.tobytes()
+    return str(payload)
+
+def _fmthead(var,val):
+    """render one header line the way email.Generator does"""
+    if len(val) <= 75 - len(var) and not val[:1].isspace() \
+            and '\n' not in val:
+        # the usual case -- nothing to fold or strip
+        return "%s: %s" % (var,val)
+    try:
+        unicode(val,'us-ascii')
+    except UnicodeError:
+        # Generator doesn't touch 8-bit values
+        return "%s: %s" % (var,val)
+    return "%s: %s" % (var, 
+        email.Header.Header(val,maxlinelen=78,header_name=var).encode())
+
+class Head(object):
+    """msg.head.foo is msg['foo'], decoded according to the type
+    setheader() recorded for it in _type_foo"""
 
-class Head:
+    __slots__ = ('_msg',)
 
     def __init__(self,msg):
-        self.__msg = msg
+        self._msg = msg
 
     def __getattr__(self,var):
-        val = self.__msg[var]
-        type = self.__msg.get("_type_%s" % var, '')
+        val = self._msg[var]
+        type = self._msg.get("_type_%s" % var, '')
         if type == 'b':
             val.strip()
             if val == '1' or val == 'True':
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# fbp822 benchmark and fuzzer.  Generates realistic message mixes --
+# heartbeats, whohas/ihave packets, 1MB snap bodies, and a 50,000
+# entry journal -- times parse and serialize for each of them, and
+# writes the results as JSON, e.g.:
+#
+#   python benchfbp822.py -o metrics/python2.7/benchfbp822.json
+#   python benchfbp822.py -b metrics/python2.7/benchfbp822.json
+#
+# usage: benchfbp822.py [-q] [-o outfile] [-b baseline] [-t tolerance]
+#                       [-s seed] [mix ...]
+#        benchfbp822.py -f iterations [-s seed] [-d dir]
+#
+#   -s  random seed (default 1)
+#   -f  fuzz instead:  mangle message streams, feed them to every
+#       parser, and complain if they don't all agree
+#   -d  where -f saves the input for each disagreement (default /tmp)
+#
+# See benchutil.py for the other flags.  Mixes are named on the
+# command line; by default all of them run.  Results are megabytes
+# and messages per second.
+
+import os
+import random
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+
+libpath = "../lib/python"
+sys.path.append(libpath)
+
+from isconf.fbp822 import fbp822, Parser822, Error822, Incomplete822
+import benchutil
+from benchutil import scale
+
+rand = random.Random(1)
+
+KEY = 'someauthenticationkey'
+factory = fbp822(authkey=KEY)
+
+# generators
+
+def word(n=8):
+    return ''.join([ rand.choice('abcdefghijklmnopqrstuvwxyz0123456789')
+        for i in xrange(n) ])
+
+def path():
+    return '/' + '/'.join([ word(rand.randint(2,10))
+        for i in xrange(rand.randint(1,5)) ])
+
+def xid():
+    return word(40)
+
+def heartbeats(n):
+    for i in xrange(n):
+        yield fbp822().mkmsg('heartbeat')
+
+def packets(n):
+    tuid = "%s@%s" % (rand.random(), word())
+    for i in xrange(n):
+        if i % 2:
+            yield factory.mkmsg('whohas',file=path().lstrip('/'),
+                newer=rand.randint(0,2000000000),tuid=tuid,frames='binary')
+        else:
+            yield factory.mkmsg('ihave',tuid=tuid,file=path().lstrip('/'),
+                mtime=rand.randint(0,2000000000),port=65028,scheme='http',
+                frames='binary')
+
+def snaps(n,size=1 << 20):
+    body = os.urandom(size)
+    for i in xrange(n):
+        yield factory.mkmsg('snap',body,pathname=path(),
+            st_mode=33188,st_uid=0,st_gid=0,st_atime=1234567890,
+            st_mtime=1234567890,xid=xid())
+
+def journal(n):
+    """what a volume's journal fills up with:  mostly snaps, some
+    execs and their scripts, and lock messages"""
+    for i in xrange(n):
+        r = rand.random()
+        if r < .7:
+            yield factory.mkmsg('snap','',pathname=path(),
+                st_mode=rand.choice((33188,33261,33184)),
+                st_uid=0,st_gid=0,st_atime=rand.randint(0,2000000000),
+                st_mtime=rand.randint(0,2000000000),blk=xid(),xid=xid(),
+                pathmodes=','.join(['16877:0:0'] * rand.randint(1,6)))
+        elif r < .95:
+            argv = [ word(rand.randint(1,12))
+                for j in xrange(rand.randint(1,8)) ]
+            yield factory.mkmsg('exec',"\n".join(argv) + "\n",
+                cwd=path(),xid=xid())
+        else:
+            yield factory.mkmsg('lock','',
+                message="%s@%s: %s" % (word(),word(),word(rand.randint(1,60))),
+                xid=xid())
+
+MIXES = (
+    ('heartbeat', lambda: heartbeats(scale(50000))),
+    ('packet', lambda: packets(scale(50000))),
+    ('snap1m', lambda: snaps(scale(50))),
+    ('journal', lambda: journal(scale(50000))),
+    )
+
+# benchmarks
+
+def rate(name,res,nmsgs,nbytes,start):
+    elapsed = time.time() - start
+    res['fbp822.%s.msgs_per_sec' % name] = nmsgs / elapsed
+    res['fbp822.%s.mb_per_sec' % name] = nbytes / elapsed / (1 << 20)
+
+def bench(mix,msgs):
+    res = {}
+    texts = [ str(msg) for msg in msgs ]
+    # journals separate entries with blank lines
+    txt = "\n\n".join(texts)
+    frames = ''.join([ msg.as_binary(unixfrom=True) for msg in msgs ])
+    n = len(msgs)
+
+    start = time.time()
+    for t in texts:
+        factory.parse(t)
+    rate('%s.parse' % mix,res,n,len(txt),start)
+
+    start = time.time()
+    for msg in factory.fromStream(StringIO(txt),intask=False):
+        pass
+    rate('%s.fromStream' % mix,res,n,len(txt),start)
+
+    start = time.time()
+    for msg in factory.fromFile(StringIO(txt),intask=False):
+        pass
+    rate('%s.fromFile' % mix,res,n,len(txt),start)
+
+    fh = tempfile.TemporaryFile()
+    fh.write(txt)
+    fh.seek(0)
+    start = time.time()
+    for msg in factory.fromFile(fh,intask=False):
+        pass
+    rate('%s.fromFile_mmap' % mix,res,n,len(txt),start)
+
+    # how Journal replays a journal
+    fh.seek(0)
+    start = time.time()
+    entries = []
+    for mlist in factory.fromFile(fh,intask=False,batch=True):
+        entries.extend(mlist)
+    rate('%s.fromFile_batch' % mix,res,n,len(txt),start)
+    fh.close()
+
+    start = time.time()
+    Parser822().feed(frames)
+    rate('%s.parse_binary' % mix,res,n,len(frames),start)
+
+    # serialize freshly parsed messages, so nothing is cached
+    parsed = Parser822().feed(txt)
+    start = time.time()
+    for msg in parsed:
+        str(msg)
+    rate('%s.serialize' % mix,res,n,len(txt),start)
+
+    parsed = Parser822().feed(txt)
+    start = time.time()
+    for msg in parsed:
+        msg.as_binary(unixfrom=True)
+    rate('%s.serialize_binary' % mix,res,n,len(frames),start)
+    return res
+
+# fuzzing
+
+def sig(msg):
+    return (msg.get_unixfrom(), tuple(msg.items()), msg.get_payload())
+
+def mangle(txt):
+    """damage txt in one of the ways a stream gets damaged"""
+    if not txt:
+        return txt
+    how = rand.randint(0,7)
+    i = rand.randint(0,len(txt) - 1)
+    if how == 0:
+        # truncate
+        return txt[:i]
+    if how == 1:
+        # flip a byte
+        return txt[:i] + chr(rand.randint(0,255)) + txt[i+1:]
+    if how == 2:
+        # drop a byte
+        return txt[:i] + txt[i+1:]
+    if how == 3:
+        # insert junk
+        return txt[:i] + os.urandom(rand.randint(1,20)) + txt[i:]
+    if how == 4:
+        # lie about a size
+        j = txt.find('_size: ',i)
+        if j < 0:
+            return txt
+        k = txt.find('\n',j)
+        return txt[:j] + '_size: %d' % rand.randint(-5,100) + txt[k:]
+    if how == 5:
+        # lose a colon
+        j = txt.find(':',i)
+        if j < 0:
+            return txt
+        return txt[:j] + txt[j+1:]
+    if how == 6:
+        # stray newlines
+        return txt[:i] + '\n' * rand.randint(1,3) + txt[i:]
+    # swap two pieces
+    j = rand.randint(i,len(txt))
+    return txt[j:] + txt[i:j] + txt[:i]
+
+def outcome(gen):
+    """(message signatures, True if it ended in an error)"""
+    sigs = []
+    try:
+        for msg in gen:
+            sigs.append(sig(msg))
+    except Error822:
+        return (sigs, True)
+    return (sigs, False)
+
+def feedall(txt,sizes):
+    parser = Parser822()
+    pos = 0
+    while pos < len(txt):
+        n = rand.choice(sizes)
+        for msg in parser.feed(txt[pos:pos+n]):
+            yield msg
+        pos += n
+    if parser.pending():
+        raise Error822("junk at end of stream")
+
+def fromfile(txt,stream,chunksize):
+    # fromFile() reports errors on stderr and stops
+    err = sys.stderr
+    sys.stderr = StringIO()
+    try:
+        for msg in factory.fromFile(stream,intask=False,chunksize=chunksize):
+            yield msg
+    finally:
+        errs = sys.stderr.getvalue()
+        sys.stderr = err
+    if errs:
+        raise Error822(errs)
+
+def variants(txt):
+    """every way we have of parsing a stream of messages"""
+    fh = tempfile.TemporaryFile()
+    fh.write(txt)
+    fh.seek(0)
+    chunk = rand.choice((1,7,100,4096,65536))
+    return [
+        ('feed', feedall(txt,[len(txt) or 1])),
+        ('feed_bytes', feedall(txt,[1])),
+        ('feed_random', feedall(txt,[1,2,3,10,100,1000,100000])),
+        ('fromFile', fromfile(txt,StringIO(txt),chunk)),
+        ('fromFile_mmap', fromfile(txt,fh,chunk)),
+        ]
+
+def parseone(txt):
+    """fbp822.parse() and Parser822 should agree on one message.
+    parse() is given the whole message, so it's strict about
+    newlines around it where a stream isn't -- strip them off --
+    and in trial mode, so it says when it needs more data."""
+    txt = txt.strip('\n')
+    try:
+        want = sig(factory.parse(txt,trial=True))
+    except Incomplete822:
+        want = 'incomplete'
+    except Error822:
+        want = 'error'
+    parser = Parser822()
+    try:
+        got = parser.feed(txt)
+        if not got:
+            got = 'incomplete'
+        elif len(got) != 1 or parser.pending():
+            got = 'error'
+        else:
+            got = sig(got[0])
+    except Error822:
+        got = 'error'
+    return want == got
+
+def fuzz(iterations,savedir):
+    bad = 0
+    for i in xrange(iterations):
+        msgs = []
+        for j in xrange(rand.randint(1,6)):
+            msgs += list(rand.choice((heartbeats,packets,journal))(1))
+        if rand.random() < .1:
+            msgs += list(snaps(1,size=rand.randint(1,100000)))
+        pieces = []
+        for msg in msgs:
+            if rand.random() < .3:
+                pieces.append(msg.as_binary(unixfrom=True))
+            else:
+                pieces.append(str(msg) + "\n" * rand.randint(0,2))
+        txt = ''.join(pieces)
+        for k in xrange(rand.randint(0,3)):
+            txt = mangle(txt)
+        results = [ (name, outcome(gen)) for (name,gen) in variants(txt) ]
+        want = results[0][1]
+        problems = [ name for (name,got) in results if got != want ]
+        one = mangle(pieces[0])
+        if not parseone(one):
+            problems.append('parse')
+            txt = one
+        if problems:
+            bad += 1
+            fn = os.path.join(savedir,"fbp822-fuzz-%d" % i)
+            open(fn,'w').write(txt)
+            print >>sys.stderr, "disagree: %s: %s" % (
+                ','.join(problems), fn)
+    print "%d of %d inputs disagreed" % (bad,iterations)
+    return bad
+
+iterations = 0
+savedir = '/tmp'
+
+def run(names):
+    if iterations:
+        if fuzz(iterations,savedir):
+            sys.exit(1)
+        sys.exit(0)
+    results = {}
+    for (name,gen) in MIXES:
+        if name in names:
+            results.update(bench(name,list(gen())))
+    return results
+
+def option(opt,val):
+    global iterations, savedir
+    if opt == '-d': savedir = val
+    if opt == '-f': iterations = int(val)
+    if opt == '-s': rand.seed(int(val))
+
+if __name__ == "__main__":
+    benchutil.main(run,[ name for (name,gen) in MIXES ],what='mix',
+        flags='d:f:s:',option=option)
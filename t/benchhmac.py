@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# HMAC benchmark -- signs fbp822 messages the way the old sha module
+# path did, and with each digest fbp822 knows about, and writes the
+# results as JSON, e.g.:
+#
+#   python benchhmac.py -o metrics/python2.7/benchhmac.json
+#   python benchhmac.py -b metrics/python2.7/benchhmac.json
+#
+# usage: benchhmac.py [-q] [-o outfile] [-b baseline] [-t tolerance]
+#                     [digest ...]
+#
+# See benchutil.py for the flags.  Digests are named on the command
+# line; by default all of them run.
+# 'sha' is the old path:  hmac over as_string() with the sha module.
+# Results are messages and megabytes signed per second.
+
+import hmac
+import sha
+import sys
+import time
+
+libpath = "../lib/python"
+sys.path.append(libpath)
+
+from isconf.fbp822 import fbp822, hmackey, digests
+import benchutil
+
+KEY = 'someauthenticationkey'
+
+def messages():
+    """(name, message) for a mesh packet, a snap journal entry, an
+    exec journal entry, and 64k and 1MB payloads"""
+    factory = fbp822()
+    return [
+        ('packet', factory.mkmsg('whohas',file='volume/generic/journal',
+            newer=1234567890,tuid='0.123456789@somehost')),
+        ('snap', factory.mkmsg('snap','',pathname='/etc/motd',
+            st_mode=33188,st_uid=0,st_gid=0,st_atime=1234567890,
+            st_mtime=1234567890,blk='a' * 40,xid='b' * 40,
+            pathmodes='16877:0:0,16877:0:0')),
+        ('exec', factory.mkmsg('exec','x' * 4096,cwd='/',xid='c' * 40)),
+        ('64k', factory.mkmsg('stdout','x' * 65536)),
+        ('1m', factory.mkmsg('stdout','x' * (1 << 20))),
+        ]
+
+def oldsign(msg):
+    # what Message.hmacset() did before digests were pluggable
+    return hmac.new(KEY,msg=msg.as_string(),digestmod=sha).hexdigest()
+
+def bench(name,sign,msg):
+    size = len(msg.as_string())
+    n = max(10, min(20000, (50 << 20) / size))
+    if benchutil.quick:
+        n = max(1, n / 10)
+    start = time.time()
+    for i in xrange(n):
+        sign(msg)
+    elapsed = time.time() - start
+    return {
+        'hmac.%s.msgs_per_sec' % name: n / elapsed,
+        'hmac.%s.mb_per_sec' % name: n * size / elapsed / (1 << 20),
+        }
+
+def run(names):
+    results = {}
+    key = hmackey(KEY)
+    for digest in names:
+        for (mname,msg) in messages():
+            if digest == 'sha':
+                sign = oldsign
+            else:
+                sign = lambda msg: msg.hmacset(key,digest)
+            results.update(bench('%s.%s' % (digest,mname),sign,msg))
+    return results
+
+if __name__ == "__main__":
+    benchutil.main(run,['sha'] + sorted(digests.keys()),what='digest')
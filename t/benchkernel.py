@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# Kernel benchmark suite -- runs the kernel headless and writes the
+# results as JSON, e.g.:
+#
+#   python benchkernel.py -o metrics/python2.7/bench.json
+#   python benchkernel.py -b metrics/python2.7/bench.json
+#
+# usage: benchkernel.py [-q] [-i idlesecs] [-o outfile] [-b baseline]
+#                       [-t tolerance] [benchmark ...]
+#
+#   -i  how long to run the idle daemon test (default 60 seconds,
+#       5 with -q)
+#
+# See benchutil.py for the other flags.  Benchmarks are named on the
+# command line; by default all of them run.  Rates are per second,
+# times are in seconds.
+
+import os
+import socket
+import sys
+import time
+
+libpath = "../lib/python"
+sys.path.append(libpath)
+
+from isconf.Kernel import kernel, Bus
+import benchutil
+from benchutil import scale
+
+idlesecs = None
+
+def cleanup():
+    kernel.killall()
+    kernel.exited = {}
+
+def spinner(what,n):
+    # tiny task which yields what, n times
+    for i in xrange(n):
+        yield what
+
+def sleeper(secs):
+    while True:
+        yield kernel.sigsleep, secs
+
+def idlereader(bus):
+    while True:
+        mlist = []
+        yield bus.rx(mlist)
+
+def bench_spawn():
+    """tasks spawned per second"""
+    n = scale(20000)
+    start = time.time()
+    for i in xrange(n):
+        kernel.spawn(sleeper(3600))
+    elapsed = time.time() - start
+    cleanup()
+    return {'spawn.per_sec': n / elapsed}
+
+def bench_steps():
+    """steps per second with N idle tasks in the background, and for
+    1000 busy tasks yielding None, sigbusy, or sleeping 0 seconds"""
+    res = {}
+    nsteps = scale(100000)
+    bus = Bus()
+    idles = [0, 100, 1000]
+    if not benchutil.quick:
+        idles.append(10000)
+    for idle in idles:
+        for i in xrange(idle / 2):
+            kernel.spawn(sleeper(3600))
+            kernel.spawn(idlereader(bus))
+        task = kernel.spawn(spinner(None,nsteps))
+        start = time.time()
+        while kernel.isrunning(task.tid):
+            kernel.run(steps=100)
+        res['steps.idle%d.per_sec' % idle] = nsteps / (time.time() - start)
+        cleanup()
+    ntasks = 1000
+    n = scale(100)
+    for (name,what) in (
+            ('none', None),
+            ('busy', kernel.sigbusy),
+            ('sleep0', (kernel.sigsleep,0)),
+            ):
+        for i in xrange(ntasks):
+            kernel.spawn(spinner(what,n))
+        start = time.time()
+        while kernel.ps():
+            kernel.run(steps=100)
+        res['steps.%s.per_sec' % name] = ntasks * n / (time.time() - start)
+        cleanup()
+    return res
+
+def bench_bus():
+    """Bus.tx() -> rx() messages delivered per second, for 1, 10 and
+    100 readers"""
+    res = {}
+    for nreaders in (1, 10, 100):
+        nmsgs = scale(100000) / nreaders
+        bus = Bus()
+        got = [0]
+        def reader():
+            while True:
+                mlist = []
+                yield bus.rx(mlist)
+                got[0] += len(mlist)
+        def writer():
+            for i in xrange(nmsgs):
+                bus.tx(i)
+                if not i % 100:
+                    yield None
+        for i in xrange(nreaders):
+            kernel.spawn(reader())
+        start = time.time()
+        kernel.spawn(writer())
+        while got[0] < nmsgs * nreaders:
+            kernel.run(steps=100)
+        elapsed = time.time() - start
+        res['bus.fanout%d.msgs_per_sec' % nreaders] = got[0] / elapsed
+        cleanup()
+    return res
+
+def bench_sleep():
+    """how late sigsleep wakes up, with 100 other tasks sleeping
+    at staggered intervals"""
+    n = scale(200)
+    late = []
+    def napper():
+        for i in xrange(n):
+            secs = .01
+            start = time.time()
+            yield kernel.sigsleep, secs
+            late.append(time.time() - start - secs)
+    for i in xrange(100):
+        kernel.spawn(sleeper(.005 + i * .0003))
+    kernel.run(napper())
+    cleanup()
+    late.sort()
+    return {
+        'sleep.jitter.mean': sum(late) / len(late),
+        'sleep.jitter.p99': late[int(len(late) * .99)],
+        'sleep.jitter.max': late[-1],
+        }
+
+def bench_idle(secs):
+    """CPU used by a kernel with an idle daemon's worth of tasks:
+    heartbeats, Bus readers, a socket reader, and a siguntil poller"""
+    bus = Bus()
+    (rsock,wsock) = socket.socketpair()
+    def sockreader():
+        while True:
+            yield kernel.sigio, [rsock], []
+            rsock.recv(4096)
+    def poller():
+        yield kernel.siguntil, lambda: False
+    for i in xrange(10):
+        kernel.spawn(sleeper(1))
+        kernel.spawn(idlereader(bus))
+    kernel.spawn(sockreader())
+    kernel.spawn(poller())
+    def init():
+        yield kernel.sigsleep, secs
+    t0 = os.times()
+    start = time.time()
+    kernel.run(init())
+    t1 = os.times()
+    elapsed = time.time() - start
+    cleanup()
+    rsock.close()
+    wsock.close()
+    cpu = (t1[0] - t0[0]) + (t1[1] - t0[1])
+    return {'idle.cpu': cpu / elapsed, 'idle.secs': elapsed}
+
+BENCHMARKS = ('spawn', 'steps', 'bus', 'sleep', 'idle')
+
+def run(names):
+    results = {}
+    for name in names:
+        if name == 'idle':
+            secs = idlesecs
+            if secs is None:
+                secs = benchutil.quick and 5 or 60
+            results.update(bench_idle(secs))
+        else:
+            results.update(globals()['bench_' + name]())
+    return results
+
+def option(opt,val):
+    global idlesecs
+    if opt == '-i': idlesecs = float(val)
+
+if __name__ == "__main__":
+    benchutil.main(run,BENCHMARKS,flags='i:',option=option)
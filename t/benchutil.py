@@ -0,0 +1,95 @@
+# Shared plumbing for the bench*.py scripts:  command line parsing,
+# JSON output, and comparison against a baseline run.  Each script
+# supplies its workloads and hands them to main().
+#
+# Every script takes:
+#
+#   -q  quick run: fewer iterations
+#   -o  write results to outfile instead of stdout
+#   -b  compare against a previous run; exit 1 if any result is
+#       more than tolerance worse
+#   -t  tolerance for -b, as a fraction (default .2)
+#
+# Results are rates unless named in LOWER.
+
+import getopt
+import json
+import platform
+import sys
+import time
+
+# smaller is better for these -- everything else is a rate
+LOWER = ('jitter', 'cpu')
+# these only record how long something ran
+IGNORE = ('secs',)
+
+quick = False
+
+def scale(n):
+    if quick:
+        return max(1, n / 10)
+    return n
+
+def compare(results,baseline,tolerance):
+    """return list of regressions against baseline"""
+    worse = []
+    names = results.keys()
+    names.sort()
+    for name in names:
+        if name.split('.')[-1] in IGNORE or not baseline.has_key(name):
+            continue
+        old = baseline[name]
+        new = results[name]
+        lower = [ s for s in LOWER if s in name.split('.') ]
+        if lower:
+            # absolute floor so a few microseconds of noise on
+            # a near-zero number doesn't count
+            bad = new > old * (1 + tolerance) and new - old > .001
+        else:
+            bad = new < old * (1 - tolerance)
+        if bad:
+            worse.append("%s: %g -> %g" % (name,old,new))
+    return worse
+
+def main(run,known,what='benchmark',flags='',option=None):
+    """Run the benchmarks named on the command line, or all of known
+    if none are, write the results as JSON, and compare them against
+    -b's baseline.  run(names) returns a dict of results.  flags are
+    getopt letters for the script's own options, each of which is
+    passed to option(opt,val)."""
+    global quick
+    outfile = None
+    basefile = None
+    tolerance = .2
+    (opts, args) = getopt.getopt(sys.argv[1:], "b:o:qt:" + flags)
+    for (opt,val) in opts:
+        if opt == '-b': basefile = val
+        elif opt == '-o': outfile = val
+        elif opt == '-q': quick = True
+        elif opt == '-t': tolerance = float(val)
+        else: option(opt,val)
+    names = args or known
+    for name in names:
+        if name not in known:
+            print >>sys.stderr, "unknown %s:" % what, name
+            sys.exit(2)
+    results = run(names)
+    out = {
+        'python': platform.python_version(),
+        'host': platform.node(),
+        'time': int(time.time()),
+        'quick': quick,
+        'results': results,
+        }
+    data = json.dumps(out,indent=1,sort_keys=True) + "\n"
+    if outfile:
+        open(outfile,'w').write(data)
+    else:
+        sys.stdout.write(data)
+    if basefile:
+        baseline = json.load(open(basefile))['results']
+        worse = compare(results,baseline,tolerance)
+        for line in worse:
+            print >>sys.stderr, "regression:", line
+        if worse:
+            sys.exit(1)
@@ -268,8 +268,7 @@ def setup(h,tdir,vdir,python):
     h.sess("echo asamplekey > %s/is/hmac_keys" % vdir)
 
 def main():
-    run(python="python2.4")
-    run(python="python2.3")
+    run(python="python2.7")
     rc = t.results()
     sys.exit(rc)
 